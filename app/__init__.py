@@ -1,14 +1,41 @@
-from flask import Flask
+import os
+from flask import Flask, request, session
+from jinja2 import FileSystemBytecodeCache
 from app.models import User
+from app import assets, jobs, tenants
 
-def create_app():
+def create_app(config=None):
     app = Flask(__name__, template_folder='../templates', static_folder='../static')
     app.secret_key = 'your-secret-key-change-this'
+    app.config.setdefault('JOBS_ENABLED', True)
+    # The live catalog feed keeps a response open per catalog page, which
+    # holds a whole worker thread under gunicorn; serve.py turns it off
+    app.config.setdefault('LIVE_UPDATES', os.environ.get('LIBRARY_LIVE_UPDATES', '1') != '0')
+    # Multi-library deployments: TENANT_MODE is 'subdomain' or 'path' (see app/tenants.py)
+    app.config.update(tenants.config_from_env())
+    app.config.update(config or {})
+    tenants.init_app(app)
     
-    from app.routes import auth_bp, library_bp, admin_bp
+    # Keep compiled templates on disk so fresh workers skip Jinja compilation
+    template_cache = os.environ.get('LIBRARY_TEMPLATE_CACHE') or os.path.join(app.instance_path, 'jinja_cache')
+    os.makedirs(template_cache, exist_ok=True)
+    app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(template_cache)}
+    
+    # Fingerprinted, precompressed static files and gzip/brotli page responses
+    assets.init_app(app)
+    
+    # A session belongs to the library it logged in to; registered before the
+    # blueprints so nothing reads the session of another library first
+    @app.before_request
+    def check_session_tenant():
+        if 'user_id' in session and session.get('tenant') != request.environ.get('library.tenant'):
+            session.clear()
+    
+    from app.routes import auth_bp, library_bp, admin_bp, api_bp
     app.register_blueprint(auth_bp)
     app.register_blueprint(library_bp)
     app.register_blueprint(admin_bp)
+    app.register_blueprint(api_bp)
     
     # Add helper function to templates
     @app.context_processor
@@ -17,4 +44,17 @@ def create_app():
             return User.find_by_username(username)
         return dict(get_user=get_user)
     
+    # Start the job scheduler on the first request, so CLI commands and the
+    # reloader's parent process never spawn one
+    @app.before_request
+    def start_background_jobs():
+        if app.config['JOBS_ENABLED']:
+            jobs.start_scheduler(data_dirs=lambda: tenants.data_dirs(app))
+    
     return app
+
+
+def precompile_templates(app):
+    """Compile every template now, filling the bytecode cache"""
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
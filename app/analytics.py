@@ -0,0 +1,169 @@
+"""Visitor analytics: time-bucketed rollups of logins, borrows and downloads.
+
+Every event is added to a daily, a weekly and a monthly bucket in
+data/analytics.json. A bucket holds a counter per metric plus a
+HyperLogLog sketch of the usernames seen, so unique visitors are counted in
+about a kilobyte per bucket instead of keeping every visit. Sketches are
+mergeable: the unique visitors of any rolling window are the union of its
+daily sketches, which costs one merge per day rather than a pass over the
+events.
+
+Buckets are stored under flat keys ("day:2026-10-19", "week:2026-W42",
+"month:2026-10") so WAL mode logs only the buckets an event touched.
+"""
+import base64
+import hashlib
+import math
+import zlib
+from datetime import datetime, timedelta
+
+from app import storage
+
+METRICS = ('logins', 'borrows', 'downloads')
+PERIODS = ('day', 'week', 'month')
+RETENTION = {'day': 400, 'week': 160}     # buckets kept; months are kept for good
+PRECISION = 10                            # 2**10 registers, about 3% error
+
+
+class HyperLogLog:
+    """Cardinality sketch (Flajolet et al.) over 64-bit hashes"""
+
+    def __init__(self, registers=None, precision=PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.size)
+
+    def add(self, value):
+        h = int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small sets
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def dumps(self):
+        # Mostly-empty registers compress to a few bytes
+        return base64.b64encode(zlib.compress(bytes(self.registers))).decode('ascii')
+
+    @classmethod
+    def loads(cls, text):
+        return cls(zlib.decompress(base64.b64decode(text)))
+
+
+def bucket_key(period, moment):
+    if period == 'day':
+        return f'day:{moment:%Y-%m-%d}'
+    if period == 'week':
+        year, week, _ = moment.isocalendar()
+        return f'week:{year}-W{week:02d}'
+    return f'month:{moment:%Y-%m}'
+
+
+def previous(period, moment):
+    """A moment in the bucket before the one containing `moment`"""
+    if period == 'day':
+        return moment - timedelta(days=1)
+    if period == 'week':
+        return moment - timedelta(weeks=1)
+    return moment.replace(day=1) - timedelta(days=1)
+
+
+def empty_bucket():
+    return {**{metric: 0 for metric in METRICS}, 'visitors': None}
+
+
+def load():
+    return storage.load('analytics.json', default=dict)
+
+
+def record_many(events):
+    """Add (metric, username or None, timestamp or None) events with one write"""
+    with storage.locked('analytics.json'):
+        data = load()
+        sketches = {}
+        touched = set()
+        for metric, username, timestamp in events:
+            moment = datetime.fromisoformat(timestamp) if timestamp else datetime.now()
+            for period in PERIODS:
+                key = bucket_key(period, moment)
+                touched.add(key)
+                bucket = data.setdefault(key, empty_bucket())
+                bucket[metric] += 1
+                if username:
+                    if key not in sketches:
+                        sketches[key] = HyperLogLog.loads(bucket['visitors']) if bucket['visitors'] else HyperLogLog()
+                    sketches[key].add(username)
+        for key, sketch in sketches.items():
+            data[key]['visitors'] = sketch.dumps()
+        storage.save('analytics.json', data, changed=sorted(touched))
+
+
+def record(metric, username=None, timestamp=None):
+    record_many([(metric, username, timestamp)])
+
+
+def series(period, limit=30, now=None):
+    """The last `limit` buckets of a period, oldest first"""
+    data = load()
+    moment = now or datetime.now()
+    rows = []
+    for _ in range(limit):
+        key = bucket_key(period, moment)
+        bucket = data.get(key) or empty_bucket()
+        rows.append({
+            'bucket': key.split(':', 1)[1],
+            **{metric: bucket[metric] for metric in METRICS},
+            'visitors': HyperLogLog.loads(bucket['visitors']).count() if bucket['visitors'] else 0
+        })
+        moment = previous(period, moment)
+    return rows[::-1]
+
+
+def unique_visitors(days=None, period='month', now=None):
+    """Unique visitors over the last `days` days (merging daily sketches), or
+    in the current bucket of `period`"""
+    data = load()
+    moment = now or datetime.now()
+    if days is None:
+        keys = [bucket_key(period, moment)]
+    else:
+        keys = [bucket_key('day', moment - timedelta(days=offset)) for offset in range(days)]
+    union = HyperLogLog()
+    for key in keys:
+        bucket = data.get(key)
+        if bucket and bucket['visitors']:
+            union.merge(HyperLogLog.loads(bucket['visitors']))
+    return union.count()
+
+
+def prune(now=None):
+    """Drop daily and weekly buckets past their retention"""
+    moment = now or datetime.now()
+    with storage.locked('analytics.json'):
+        data = load()
+        expired = []
+        for period, keep in RETENTION.items():
+            oldest = moment
+            for _ in range(keep - 1):
+                oldest = previous(period, oldest)
+            cutoff = bucket_key(period, oldest)
+            expired += [key for key in data if key.startswith(f'{period}:') and key < cutoff]
+        for key in expired:
+            del data[key]
+        if expired:
+            storage.save('analytics.json', data, changed=[])
+        return len(expired)
@@ -0,0 +1,167 @@
+"""Serve the Flask app under an ASGI server.
+
+The event loop owns the sockets, so idle keep-alive connections and slow
+clients cost a coroutine rather than a thread. Request bodies are read on
+the loop before the app is called, and the app itself (storage reads and
+writes, QR encoding) runs on a bounded thread pool so blocking work never
+stalls the loop. Event streams (response bodies with a stream_async()
+method, see app/events.py) wait for events on the loop itself, so an open
+catalog page costs no thread. At most LIBRARY_ASGI_STREAMS are served at
+once; beyond that a stream request gets 503, which makes EventSource stop
+reconnecting.
+"""
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+_END = object()
+
+
+class WSGIToASGI:
+    def __init__(self, wsgi_app, max_workers=None):
+        self.wsgi_app = wsgi_app
+        self.max_workers = max_workers or int(os.environ.get('LIBRARY_ASGI_THREADS', 0)) or min(32, (os.cpu_count() or 1) + 4)
+        self.max_streams = int(os.environ.get('LIBRARY_ASGI_STREAMS', 0)) or 1000
+        self.streams = 0
+        self.executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+        else:
+            raise RuntimeError(f'Unsupported ASGI scope type: {scope["type"]}')
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.get_executor()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.executor:
+                    self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='library-wsgi')
+        return self.executor
+
+    async def handle_http(self, scope, receive, send):
+        body = BytesIO()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+
+        loop = asyncio.get_running_loop()
+        executor = self.get_executor()
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return lambda data: None
+
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = loop.create_task(watch_disconnect())
+        iterable = None
+        try:
+            iterable = await loop.run_in_executor(executor, self.wsgi_app, build_environ(scope, body), start_response)
+            if hasattr(iterable, 'stream_async'):
+                await self.send_stream(iterable, response, send, disconnected)
+                return
+            chunks = iter(iterable)
+            chunk = await loop.run_in_executor(executor, next, chunks, _END)
+            await send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+            while chunk is not _END and not disconnected.is_set():
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(executor, next, chunks, _END)
+            if not disconnected.is_set():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            watcher.cancel()
+            if iterable is not None and hasattr(iterable, 'close'):
+                await loop.run_in_executor(executor, iterable.close)
+
+    async def send_stream(self, stream, response, send, disconnected):
+        """Send an event stream as it produces chunks, until the client goes"""
+        if self.streams >= self.max_streams:
+            await send({'type': 'http.response.start', 'status': 503,
+                        'headers': [(b'content-type', b'text/plain'), (b'retry-after', b'60')]})
+            await send({'type': 'http.response.body', 'body': b'Too many open event streams'})
+            return
+        self.streams += 1
+        chunks = stream.stream_async()
+        gone = asyncio.ensure_future(disconnected.wait())
+        try:
+            await send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+            while True:
+                chunk = asyncio.ensure_future(chunks.__anext__())
+                await asyncio.wait({chunk, gone}, return_when=asyncio.FIRST_COMPLETED)
+                if not chunk.done():
+                    # Let the generator unwind before it is closed below
+                    chunk.cancel()
+                    await asyncio.wait({chunk})
+                    return
+                try:
+                    body = chunk.result()
+                except StopAsyncIteration:
+                    break
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            self.streams -= 1
+            gone.cancel()
+            await chunks.aclose()
+
+
+def build_environ(scope, body):
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
@@ -0,0 +1,165 @@
+"""Static asset fingerprinting and response compression.
+
+At startup every file in static/ is hashed and given a fingerprinted name
+(style.css -> style.3f2a9c1b7d4e.css). url_for('static', filename=...) emits
+the fingerprinted name, which is served with a one-year immutable cache
+header: a changed file gets a new name, so browsers never need to
+revalidate. Assets are precompressed once with gzip (and brotli if the
+optional `brotli` package is installed) and served in the encoding the
+client prefers.
+
+Dynamic HTML, text and JSON responses above COMPRESS_MIN_SIZE bytes are
+compressed on the fly. Streamed responses (the live catalog feed) are left
+alone.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+COMPRESSIBLE = {
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/javascript',
+    'application/javascript', 'application/json', 'image/svg+xml',
+}
+MIN_SIZE = 1024     # smaller bodies gain less than the header overhead
+
+
+def encodings():
+    return ('br', 'gzip') if brotli else ('gzip',)
+
+
+def compress(data, encoding, precompress=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if precompress else 5)
+    return gzip.compress(data, compresslevel=9 if precompress else 6, mtime=0)
+
+
+def negotiate(available):
+    """The client's preferred encoding among `available`, or None"""
+    accept = request.accept_encodings
+    best = max(available, key=lambda encoding: accept.quality(encoding), default=None)
+    return best if best and accept.quality(best) > 0 else None
+
+
+class Asset:
+    def __init__(self, path, name):
+        with open(path, 'rb') as f:
+            self.body = f.read()
+        self.mtime = os.stat(path).st_mtime_ns
+        self.digest = hashlib.sha256(self.body).hexdigest()[:12]
+        stem, ext = os.path.splitext(name)
+        self.hashed_name = f'{stem}.{self.digest}{ext}'
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.encoded = {}
+        if self.mimetype in COMPRESSIBLE:
+            for encoding in encodings():
+                data = compress(self.body, encoding, precompress=True)
+                if len(data) < len(self.body):
+                    self.encoded[encoding] = data
+
+
+class AssetManifest:
+    def __init__(self, folder):
+        self.folder = folder
+        self.build()
+
+    def build(self):
+        self.assets = {}
+        self.by_hashed_name = {}
+        for root, _, files in os.walk(self.folder):
+            for file in files:
+                path = os.path.join(root, file)
+                name = os.path.relpath(path, self.folder).replace(os.sep, '/')
+                asset = Asset(path, name)
+                self.assets[name] = asset
+                self.by_hashed_name[asset.hashed_name] = asset
+
+    def refresh(self):
+        """Rebuild if any file was added, removed or changed (debug mode)"""
+        current = {}
+        for root, _, files in os.walk(self.folder):
+            for file in files:
+                path = os.path.join(root, file)
+                current[os.path.relpath(path, self.folder).replace(os.sep, '/')] = os.stat(path).st_mtime_ns
+        if current != {name: asset.mtime for name, asset in self.assets.items()}:
+            self.build()
+
+    def serve(self, asset):
+        encoding = negotiate(asset.encoded)
+        response = Response(asset.encoded[encoding] if encoding else asset.body, mimetype=asset.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Cache-Control'] = IMMUTABLE
+        response.vary.add('Accept-Encoding')
+        response.set_etag(f'{asset.digest}-{encoding or "identity"}')
+        return response.make_conditional(request)
+
+
+def compress_response(response, min_size=MIN_SIZE):
+    """Compress a dynamic response in place if the client accepts it"""
+    # Generators (the event stream) are streamed; send_file() bodies are
+    # passed through as file wrappers and can be read in
+    streamed = response.is_streamed and not response.direct_passthrough
+    if (response.status_code != 200 or streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE
+            or request.endpoint == 'static'):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and response.content_length < min_size:
+        return response
+    encoding = negotiate(encodings())
+    if not encoding:
+        return response
+    response.direct_passthrough = False
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Accept-Ranges', None)
+    etag, _ = response.get_etag()
+    if etag:
+        # The compressed body is a different representation
+        response.set_etag(f'{etag}-{encoding}', weak=True)
+    return response
+
+
+def init_app(app):
+    """Fingerprint static/, serve it with immutable caching and compress
+    dynamic responses"""
+    app.config.setdefault('COMPRESS_MIN_SIZE', MIN_SIZE)
+    manifest = AssetManifest(app.static_folder)
+    app.extensions['assets'] = manifest
+    send_static_file = app.view_functions['static']
+
+    def static(filename):
+        asset = manifest.by_hashed_name.get(filename)
+        if asset is None:
+            return send_static_file(filename=filename)
+        return manifest.serve(asset)
+
+    app.view_functions['static'] = static
+
+    @app.url_defaults
+    def fingerprint_static_urls(endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            if app.debug:
+                manifest.refresh()
+            asset = manifest.assets.get(values['filename'])
+            if asset:
+                values['filename'] = asset.hashed_name
+
+    @app.after_request
+    def compress_dynamic_response(response):
+        return compress_response(response, app.config['COMPRESS_MIN_SIZE'])
+
+    return manifest
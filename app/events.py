@@ -0,0 +1,156 @@
+"""In-process change feed for catalog availability.
+
+The models publish a small event whenever a book is borrowed, returned,
+edited, deleted or its hold queue changes; the /catalog/events endpoint
+streams them to open catalog pages as Server-Sent Events. There is one
+shared broadcaster per process (per library in a multi-library deployment),
+and every subscriber gets a bounded buffer:
+a client that falls too far behind loses the oldest events and is told to
+resync instead of holding memory for ever.
+
+Events only reach clients connected to the process that made the change,
+so run a single worker process (threads or ASGI) for live updates.
+
+A stream response body is an EventStream. WSGI servers iterate it, which
+blocks a thread per open page; the ASGI adapter calls stream_async()
+instead, which waits for events on the event loop and uses no thread.
+"""
+import asyncio
+import threading
+from collections import deque
+
+from app import storage
+
+BUFFER_SIZE = 100
+
+
+class Subscription:
+    def __init__(self, maxlen=BUFFER_SIZE):
+        self.queue = deque(maxlen=maxlen)
+        self.cond = threading.Condition(threading.Lock())
+        self.overflowed = False
+        self.waiter = None      # called after every push, from the publisher's thread
+
+    def push(self, event):
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.overflowed = True
+            self.queue.append(event)
+            self.cond.notify()
+            waiter = self.waiter
+        if waiter:
+            waiter()
+
+    def get(self, timeout=None):
+        """Wait for events and return them all, or [] on timeout. After an
+        overflow a single resync event replaces the buffered ones."""
+        with self.cond:
+            if timeout != 0:
+                self.cond.wait_for(lambda: self.queue, timeout)
+            if self.overflowed:
+                self.overflowed = False
+                self.queue.clear()
+                return [{'type': 'resync'}]
+            events = list(self.queue)
+            self.queue.clear()
+            return events
+
+
+class Broadcaster:
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.subscribers = set()
+
+    def subscribe(self):
+        subscription = Subscription(self.buffer_size)
+        with self.lock:
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def publish(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            subscription.push(event)
+
+
+class EventStream:
+    """Response body streaming one subscription. `render` turns a batch of
+    events ([] after `keepalive` idle seconds) into bytes to send."""
+
+    def __init__(self, broadcaster, render, keepalive, retry=5000):
+        self.broadcaster = broadcaster
+        self.subscription = broadcaster.subscribe()
+        self.render = render
+        self.keepalive = keepalive
+        self.retry = retry
+
+    def __iter__(self):
+        yield f'retry: {self.retry}\n\n'.encode()
+        while True:
+            yield self.render(self.subscription.get(timeout=self.keepalive))
+
+    async def stream_async(self):
+        """Async iterator over the same chunks, for the ASGI adapter"""
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        self.subscription.waiter = lambda: loop.call_soon_threadsafe(wakeup.set)
+        yield f'retry: {self.retry}\n\n'.encode()
+        while True:
+            try:
+                await asyncio.wait_for(wakeup.wait(), self.keepalive)
+            except asyncio.TimeoutError:
+                pass
+            # Cleared before draining, so a push racing with us sets it again
+            wakeup.clear()
+            yield self.render(self.subscription.get(timeout=0))
+
+    def close(self):
+        self.subscription.waiter = None
+        self.broadcaster.unsubscribe(self.subscription)
+
+
+_broadcasters = {}
+_broadcasters_lock = threading.Lock()
+
+
+def get_broadcaster():
+    """The broadcaster for the current library"""
+    data_dir = storage.get_data_dir()
+    with _broadcasters_lock:
+        if data_dir not in _broadcasters:
+            _broadcasters[data_dir] = Broadcaster()
+        return _broadcasters[data_dir]
+
+
+def publish_book(book, queue=()):
+    """Publish the current availability and hold queue of a book"""
+    get_broadcaster().publish({
+        'type': 'book',
+        'id': book['id'],
+        'title': book['title'],
+        'available': book['available'],
+        'borrowed_by': book['borrowed_by'],
+        'queue': list(queue)
+    })
+
+
+def for_user(event, username):
+    """The event as sent to one user: the hold queue is reduced to its length
+    and the user's own position, so usernames in it are never exposed"""
+    if 'queue' not in event:
+        return event
+    event = dict(event)
+    queue = event.pop('queue')
+    event['holds'] = len(queue)
+    event['position'] = queue.index(username) + 1 if username in queue else None
+    return event
+
+
+def publish_deleted(book_id):
+    get_broadcaster().publish({'type': 'deleted', 'id': book_id})
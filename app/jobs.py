@@ -0,0 +1,253 @@
+"""Lightweight in-process job queue and scheduler.
+
+Jobs are stored in data/jobs.json so queued work survives restarts. The
+scheduler thread is started from create_app() and jobs can also be run
+out-of-band with the CLI in app/jobs_cli.py:
+
+    python -m app.jobs_cli list
+    python -m app.jobs_cli run [--name NAME]
+    python -m app.jobs_cli enqueue NAME
+
+In a multi-library deployment every library has its own queue; the
+scheduler works through each of them in turn, and the commands take
+--tenant NAME.
+"""
+import threading
+import traceback
+import uuid
+from datetime import datetime, timedelta
+
+from app import storage, recommendations
+from app.models import User, Stats, BookRequest
+
+POLL_INTERVAL = 5           # seconds between queue scans
+BASE_BACKOFF = 30           # seconds, doubled on every failed attempt
+MAX_ATTEMPTS = 5
+LEASE_SECONDS = 300         # a running job is retried if its worker dies
+FAILED_KEPT = 20            # failed entries kept for inspection, newest first
+REQUEST_EXPIRY_DAYS = 90
+
+_registry = {}
+_periodic = {}
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_scheduler = None
+
+
+def job(name=None, every=None):
+    """Register a function as a job, optionally repeating every N seconds"""
+    def decorator(f):
+        job_name = name or f.__name__
+        _registry[job_name] = f
+        if every:
+            _periodic[job_name] = every
+        return f
+    return decorator
+
+
+def job_names():
+    return sorted(_registry)
+
+
+def load_queue():
+    return storage.load('jobs.json', default=list)
+
+
+def save_queue(jobs):
+    storage.save('jobs.json', jobs)
+
+
+def enqueue(name, delay=0, **kwargs):
+    """Queue a job to run after `delay` seconds and return its id"""
+    if name not in _registry:
+        raise KeyError(f'Unknown job: {name}')
+    entry = {
+        'id': uuid.uuid4().hex,
+        'name': name,
+        'kwargs': kwargs,
+        'status': 'queued',
+        'attempts': 0,
+        'run_at': (datetime.now() + timedelta(seconds=delay)).isoformat(),
+        'leased_until': None,
+        'last_error': None,
+        'created_at': datetime.now().isoformat()
+    }
+    with storage.locked('jobs.json'):
+        jobs = load_queue()
+        jobs.append(entry)
+        save_queue(jobs)
+    _wakeup.set()
+    return entry['id']
+
+
+def _periodic_entry(name, run_at, now):
+    return {
+        'id': uuid.uuid4().hex,
+        'name': name,
+        'kwargs': {},
+        'status': 'queued',
+        'attempts': 0,
+        'run_at': run_at.isoformat(),
+        'leased_until': None,
+        'last_error': None,
+        'created_at': now.isoformat()
+    }
+
+
+def _ensure_periodic(jobs, now):
+    """Make sure every periodic job has a queued entry; returns True if any
+    were added"""
+    queued = {j['name'] for j in jobs if j['status'] == 'queued'}
+    added = False
+    for name in _periodic:
+        if name not in queued:
+            added = True
+            jobs.append(_periodic_entry(name, now, now))
+    return added
+
+
+def _prune_failed(jobs):
+    """Drop all but the newest FAILED_KEPT failed entries"""
+    failed = [j['id'] for j in jobs if j['status'] == 'failed']
+    dropped = set(failed[:-FAILED_KEPT])
+    return [j for j in jobs if j['id'] not in dropped]
+
+
+def _claim_due(now, name=None):
+    """Lease all due jobs to this worker and return them"""
+    with storage.locked('jobs.json'):
+        jobs = load_queue()
+        added = _ensure_periodic(jobs, now)
+        due = []
+        for entry in jobs:
+            if entry['status'] != 'queued' or (name and entry['name'] != name):
+                continue
+            if entry['leased_until'] and entry['leased_until'] > now.isoformat():
+                continue
+            if entry['run_at'] <= now.isoformat():
+                entry['leased_until'] = (now + timedelta(seconds=LEASE_SECONDS)).isoformat()
+                due.append(dict(entry))
+        if due or added:
+            save_queue(jobs)
+    return due
+
+
+def _finish(entry, error=None):
+    now = datetime.now()
+    with storage.locked('jobs.json'):
+        jobs = load_queue()
+        jobs = [j for j in jobs if j['id'] != entry['id']]
+        if error is not None:
+            entry['attempts'] += 1
+            entry['last_error'] = error
+            entry['leased_until'] = None
+            if entry['attempts'] >= MAX_ATTEMPTS:
+                entry['status'] = 'failed'
+                if entry['name'] in _periodic:
+                    # Try again at the next interval rather than straight away
+                    run_at = now + timedelta(seconds=_periodic[entry['name']])
+                    jobs.append(_periodic_entry(entry['name'], run_at, now))
+            else:
+                backoff = BASE_BACKOFF * 2 ** (entry['attempts'] - 1)
+                entry['run_at'] = (now + timedelta(seconds=backoff)).isoformat()
+            jobs.append(entry)
+            jobs = _prune_failed(jobs)
+        elif entry['name'] in _periodic and not any(
+                j['name'] == entry['name'] and j['status'] == 'queued' for j in jobs):
+            entry.update(
+                id=uuid.uuid4().hex,
+                attempts=0,
+                leased_until=None,
+                last_error=None,
+                run_at=(now + timedelta(seconds=_periodic[entry['name']])).isoformat()
+            )
+            jobs.append(entry)
+        save_queue(jobs)
+
+
+def run_pending(name=None):
+    """Run every due job once and return how many ran"""
+    due = _claim_due(datetime.now(), name)
+    for entry in due:
+        func = _registry.get(entry['name'])
+        try:
+            if func is None:
+                raise KeyError(f'Unknown job: {entry["name"]}')
+            func(**entry['kwargs'])
+        except Exception:
+            _finish(entry, error=traceback.format_exc(limit=3))
+        else:
+            _finish(entry)
+    return len(due)
+
+
+class Scheduler(threading.Thread):
+    def __init__(self, interval=POLL_INTERVAL, data_dirs=None):
+        super().__init__(name='library-jobs', daemon=True)
+        self.interval = interval
+        self.data_dirs = data_dirs
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            for data_dir in self.data_dirs() if self.data_dirs else [None]:
+                try:
+                    with storage.use_data_dir(data_dir):
+                        run_pending()
+                except Exception:
+                    traceback.print_exc()
+            _wakeup.wait(self.interval)
+            _wakeup.clear()
+
+    def stop(self):
+        self.stopped.set()
+        _wakeup.set()
+
+
+def start_scheduler(interval=POLL_INTERVAL, data_dirs=None):
+    """Start the background scheduler once per process. `data_dirs` returns
+    the data directories to serve, for multi-library deployments."""
+    global _scheduler
+    if _scheduler is not None and _scheduler.is_alive():
+        return _scheduler
+    with _lock:
+        if _scheduler is None or not _scheduler.is_alive():
+            _scheduler = Scheduler(interval, data_dirs)
+            _scheduler.start()
+    return _scheduler
+
+
+# JOBS
+@job('track_visitor')
+def track_visitor(username, timestamp=None):
+    Stats.track_visitor(username, timestamp=timestamp)
+
+
+@job('track_borrows')
+def track_borrows(usernames, timestamp=None):
+    Stats.track_borrows(usernames, timestamp=timestamp)
+
+
+@job('track_e_book_download')
+def track_e_book_download(username=None, timestamp=None):
+    Stats.track_e_book_download(username, timestamp=timestamp)
+
+
+@job('compact_stats', every=24 * 3600)
+def compact_stats():
+    Stats.compact_stats()
+
+
+@job('refresh_dashboard_stats', every=300)
+def refresh_dashboard_stats():
+    Stats.refresh_cached_dashboard_stats()
+
+
+@job('expire_book_requests', every=24 * 3600)
+def expire_book_requests():
+    BookRequest.expire_stale(REQUEST_EXPIRY_DAYS)
+
+
+@job('rebuild_recommendations', every=24 * 3600)
+def rebuild_recommendations():
+    recommendations.rebuild(User.load_all())
@@ -0,0 +1,55 @@
+"""Command line for the background job queue (see app/jobs.py).
+
+    python -m app.jobs_cli list
+    python -m app.jobs_cli run [--name NAME]
+    python -m app.jobs_cli enqueue NAME
+
+Not available in WAL mode, where only the server process may open the data.
+Kept apart from app.jobs, which create_app() imports, so running it with -m
+does not load the jobs module twice.
+"""
+import argparse
+
+from app import jobs, storage, tenants
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m app.jobs_cli', description='Run library background jobs')
+    parser.add_argument('--tenant', help='library to work on in a multi-library deployment')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help='show queued and failed jobs')
+    run_parser = sub.add_parser('run', help='run all due jobs once')
+    run_parser.add_argument('--name', help='only run jobs with this name')
+    enqueue_parser = sub.add_parser('enqueue', help='queue a job to run now')
+    enqueue_parser.add_argument('name', choices=jobs.job_names())
+    args = parser.parse_args(argv)
+    if storage.STORAGE_MODE == 'wal':
+        # The server process owns the data in WAL mode and its scheduler runs
+        # the queue; opening the store here would replay and checkpoint the
+        # log under it
+        parser.error('not available with LIBRARY_STORAGE_MODE=wal; the server runs queued jobs itself')
+
+    data_dir = None
+    if args.tenant:
+        registry = tenants.TenantRegistry(tenants.default_root())
+        data_dir = registry.data_dir(args.tenant)
+        if data_dir is None:
+            parser.error(f'no library named {args.tenant!r} in {registry.root}')
+    with storage.use_data_dir(data_dir):
+        run_command(args)
+
+
+def run_command(args):
+    if args.command == 'list':
+        for entry in jobs.load_queue():
+            print(f"{entry['status']:7} {entry['name']:24} run_at={entry['run_at']} attempts={entry['attempts']}")
+            if entry['last_error']:
+                print('        ' + entry['last_error'].strip().splitlines()[-1])
+    elif args.command == 'run':
+        print(f'Ran {jobs.run_pending(args.name)} job(s)')
+    elif args.command == 'enqueue':
+        print(f'Queued {args.name} ({jobs.enqueue(args.name)})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Fuzzy matching of book titles and authors.
+
+Used to catch book requests for titles that are already in the catalog or
+already requested. Titles and authors are normalised (case, accents,
+punctuation, a leading English article) into keys, so spelling variants of
+the same book share a key and are found with one dict lookup. Near misses
+such as typos are found through a trigram inverted index: only entries that
+share trigrams with the query are scored, so a lookup touches a few posting
+lists instead of every title.
+
+Indexes are built with storage.derive(), so they are rebuilt only when the
+underlying data file changes.
+"""
+import difflib
+import re
+import unicodedata
+
+LEADING_ARTICLES = {'the', 'a', 'an'}
+MATCH_SIMILARITY = 0.75     # worth pointing out to an admin
+SAME_SIMILARITY = 0.9       # treated as the same book
+
+
+def normalize(text, drop_article=True):
+    """Lowercase, strip accents and punctuation, and drop a leading article"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    words = re.findall(r'[a-z0-9]+', text)
+    if drop_article and len(words) > 1 and words[0] in LEADING_ARTICLES:
+        words = words[1:]
+    return ' '.join(words)
+
+
+def trigrams(key):
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def same_author(a, b):
+    """Compare normalised author keys by surname (the last word, allowing a
+    typo) and given names: the initials of the shorter name must all appear
+    among the longer one's, so a dropped first or middle name or particle
+    still matches. A surname on its own matches any given names, and an
+    unknown author on either side matches anyone.
+
+    >>> same_author('w golding', 'william golding')
+    True
+    >>> same_author('jrr tolkien', 'j r r tolkien'), same_author('tolkein', 'j r r tolkien')
+    (True, True)
+    >>> same_author('scott fitzgerald', 'f scott fitzgerald')
+    True
+    >>> same_author('de cervantes', 'miguel de cervantes')
+    True
+    >>> same_author('li', 'william shakespeare'), same_author('karel capek', 'josef capek')
+    (False, False)
+    """
+    a, b = a.split(), b.split()
+    if not a or not b:
+        return True
+    if a[-1] != b[-1] and difflib.SequenceMatcher(None, a[-1], b[-1]).ratio() < MATCH_SIMILARITY:
+        return False
+    shorter, longer = sorted((a[:-1], b[:-1]), key=len)
+    return {word[0] for word in shorter} <= {word[0] for word in longer}
+
+
+def similarity(a, b):
+    """Dice coefficient of two trigram sets"""
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+class MatchIndex:
+    """Index of (id, title, author) entries for exact and fuzzy lookups"""
+
+    def __init__(self, entries):
+        self.by_key = {}
+        self.postings = {}
+        self.entries = {}
+        for entry_id, title, author in entries:
+            title_key, author_key = normalize(title), normalize(author, drop_article=False)
+            title_grams = trigrams(title_key)
+            self.entries[entry_id] = (title_grams, author_key)
+            self.by_key.setdefault((title_key, author_key), []).append(entry_id)
+            for gram in title_grams:
+                self.postings.setdefault(gram, []).append(entry_id)
+
+    def find(self, title, author, threshold=MATCH_SIMILARITY):
+        """[(score, id)] of entries similar to title/author, best first.
+
+        The score is the title similarity; the authors must also be the
+        same (see same_author)."""
+        title_key, author_key = normalize(title), normalize(author, drop_article=False)
+        matches = {entry_id: 1.0 for entry_id in self.by_key.get((title_key, author_key), [])}
+
+        title_grams = trigrams(title_key)
+        shared = {}
+        for gram in title_grams:
+            for entry_id in self.postings.get(gram, ()):
+                shared[entry_id] = shared.get(entry_id, 0) + 1
+        # dice >= threshold needs at least threshold * |query| / 2 shared trigrams
+        needed = threshold * len(title_grams) / 2
+        for entry_id, count in shared.items():
+            if entry_id in matches or count < needed:
+                continue
+            entry_title, entry_author = self.entries[entry_id]
+            score = 2 * count / (len(title_grams) + len(entry_title))
+            if score < threshold:
+                continue
+            if not same_author(author_key, entry_author):
+                continue
+            matches[entry_id] = score
+        return sorted(((score, entry_id) for entry_id, score in matches.items()), key=lambda m: (-m[0], m[1]))
+
+    def best(self, title, author, threshold=MATCH_SIMILARITY):
+        """Id of the closest entry scoring at least `threshold`, or None"""
+        found = self.find(title, author, threshold)
+        return found[0][1] if found else None
@@ -1,33 +1,46 @@
-import json
-import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
+from app import storage, recommendations, events, matching, analytics
 
-DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+# Maturita reading-list categories and the minimum number of books in each
+MATURITA_CATEGORIES = {
+    'world_czech_18': 2,
+    'world_czech_19': 3,
+    'world_20_21': 4,
+    'czech_20_21': 5
+}
+
+# Every read-modify-write cycle runs under storage.locked() for its file and
+# looks records up in the list it is about to save. A mutation that spans
+# several files takes the locks in this order: book_requests.json,
+# books.json, holds.json, users.json, then recommendations, analytics and
+# stats.
 
 class User:
     @staticmethod
     def load_all():
-        users_file = os.path.join(DATA_DIR, 'users.json')
-        if not os.path.exists(users_file):
-            return []
-        with open(users_file, 'r') as f:
-            return json.load(f)
+        return storage.load('users.json', default=list)
     \
     @staticmethod
-    def save_all(users):
-        users_file = os.path.join(DATA_DIR, 'users.json')
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(users_file, 'w') as f:
-            json.dump(users, f, indent=2)
+    def save_all(users, changed=None):
+        storage.save('users.json', users, changed=changed)
+    
+    @staticmethod
+    def index_by_username(users):
+        return {user['username']: user for user in users}
+    
+    @staticmethod
+    def load_index():
+        return storage.derive('users.json', User.index_by_username, default=list)
+    
+    @staticmethod
+    def load_indexed():
+        """(users, index by username) from the same snapshot"""
+        return storage.load_indexed('users.json', User.index_by_username, default=list)
     
     @staticmethod
     def find_by_username(username):
-        users = User.load_all()
-        for user in users:
-            if user['username'] == username:
-                return user
-        return None
+        return User.load_index().get(username)
     
     @staticmethod
     def create(username, password, email, is_admin=False, tags=None):
@@ -37,70 +50,131 @@ class User:
         if tags is None:
             tags = []
         
-        users = User.load_all()
-        user = {
-            'id': max([u['id'] for u in users], default=0) + 1,
-            'username': username,
-            'password': generate_password_hash(password),
-            'email': email,
-            'is_admin': is_admin,
-            'tags': tags,
-            'wishlist': [],
-            'maturita_list': [],
-            'created_at': datetime.now().isoformat()
-        }
-        users.append(user)
-        User.save_all(users)
-        return user
+        password_hash = generate_password_hash(password)
+        with storage.locked('users.json'):
+            users, index = User.load_indexed()
+            if username in index:
+                return None
+            user = {
+                'id': max([u['id'] for u in users], default=0) + 1,
+                'username': username,
+                'password': password_hash,
+                'email': email,
+                'is_admin': is_admin,
+                'tags': tags,
+                'wishlist': [],
+                'maturita_list': [],
+                'notifications': [],
+                'created_at': datetime.now().isoformat()
+            }
+            users.append(user)
+            User.save_all(users, changed=[])
+            return user
     
     @staticmethod
     def update(username, **kwargs):
-        users = User.load_all()
-        for user in users:
-            if user['username'] == username:
-                user.update(kwargs)
-                User.save_all(users)
-                return user
-        return None
+        with storage.locked('users.json'):
+            users, index = User.load_indexed()
+            user = index.get(username)
+            if not user:
+                return None
+            user.update(kwargs)
+            User.save_all(users, changed=[user['id']])
+            return user
+    
+    @staticmethod
+    def saved_books(user):
+        """Ids of every book on the user's wishlist or maturita list"""
+        return set(user.get('wishlist', [])) | set(user.get('maturita_list', []))
+    
+    @staticmethod
+    def apply_list_changes(username, changes):
+        """Apply (list_name, action, book_id) changes to the user's wishlist and
+        maturita list with a single write. Returns one bool per change, True if
+        it changed the list."""
+        with storage.locked('users.json'):
+            users, index = User.load_indexed()
+            user = index.get(username)
+            if not user:
+                return [False] * len(changes)
+            
+            results = []
+            co_saves = []
+            for list_name, action, book_id in changes:
+                items = user.setdefault(list_name, [])
+                saved_before = User.saved_books(user)
+                if action == 'add' and book_id not in items:
+                    items.append(book_id)
+                elif action == 'remove' and book_id in items:
+                    items.remove(book_id)
+                else:
+                    results.append(False)
+                    continue
+                results.append(True)
+                
+                saved_after = User.saved_books(user)
+                if book_id in saved_after and book_id not in saved_before:
+                    co_saves.append((book_id, saved_before, 1))
+                elif book_id in saved_before and book_id not in saved_after:
+                    co_saves.append((book_id, saved_after, -1))
+            
+            if any(results):
+                User.save_all(users, changed=[user['id']])
+                recommendations.record_changes(co_saves)
+            return results
     
     @staticmethod
     def add_to_wishlist(username, book_id):
-        user = User.find_by_username(username)
-        if user and book_id not in user.get('wishlist', []):
-            user['wishlist'].append(book_id)
-            User.update(username, wishlist=user['wishlist'])
-            return True
-        return False
+        return User.apply_list_changes(username, [('wishlist', 'add', book_id)])[0]
     
     @staticmethod
     def remove_from_wishlist(username, book_id):
-        user = User.find_by_username(username)
-        if user and book_id in user.get('wishlist', []):
-            user['wishlist'].remove(book_id)
-            User.update(username, wishlist=user['wishlist'])
-            return True
-        return False
+        return User.apply_list_changes(username, [('wishlist', 'remove', book_id)])[0]
     
     @staticmethod
     def add_to_maturita(username, book_id):
-        user = User.find_by_username(username)
-        if user:
-            maturita = user.get('maturita_list', [])
-            if book_id not in maturita:
-                maturita.append(book_id)
-                User.update(username, maturita_list=maturita)
-                return True
-        return False
+        return User.apply_list_changes(username, [('maturita_list', 'add', book_id)])[0]
     
     @staticmethod
     def remove_from_maturita(username, book_id):
+        return User.apply_list_changes(username, [('maturita_list', 'remove', book_id)])[0]
+    
+    @staticmethod
+    def notify(username, message):
+        """Queue a message to be flashed on the user's next request"""
+        return User.notify_many([(username, message)]) > 0
+    
+    @staticmethod
+    def notify_many(messages):
+        """Queue several (username, message) notifications with a single write"""
+        with storage.locked('users.json'):
+            users, index = User.load_indexed()
+            delivered = []
+            for username, message in messages:
+                user = index.get(username)
+                if user:
+                    user.setdefault('notifications', []).append(message)
+                    delivered.append(user['id'])
+            if delivered:
+                User.save_all(users, changed=delivered)
+            return len(delivered)
+    
+    @staticmethod
+    def pop_notifications(username):
+        """Return and clear the user's pending notifications"""
+        # Runs on every request, so only lock when there is something to pop
         user = User.find_by_username(username)
-        if user and book_id in user.get('maturita_list', []):
-            maturita = user['maturita_list']
-            maturita.remove(book_id)
-            User.update(username, maturita_list=maturita)
-            return True
-        return False
+        if not user or not user.get('notifications'):
+            return []
+        with storage.locked('users.json'):
+            users, index = User.load_indexed()
+            user = index.get(username)
+            notifications = user.get('notifications') if user else None
+            if not notifications:
+                return []
+            user['notifications'] = []
+            User.save_all(users, changed=[user['id']])
+            return notifications
     
     @staticmethod
     def verify_password(username, password):
@@ -113,73 +187,153 @@ class User:
 class Book:
     @staticmethod
     def load_all():
-        books_file = os.path.join(DATA_DIR, 'books.json')
-        if not os.path.exists(books_file):
-            return []
-        with open(books_file, 'r') as f:
-            return json.load(f)
+        return storage.load('books.json', default=list)
     
     @staticmethod
-    def save_all(books):
-        books_file = os.path.join(DATA_DIR, 'books.json')
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(books_file, 'w') as f:
-            json.dump(books, f, indent=2)
+    def save_all(books, changed=None):
+        storage.save('books.json', books, changed=changed)
     
     @staticmethod
     def create(title, author, genre, period, literature_type=None, available=True):
-        books = Book.load_all()
-        book = {
-            'id': max([b['id'] for b in books], default=0) + 1,
-            'title': title,
-            'author': author,
-            'genre': genre,
-            'period': period,
-            'literature_type': literature_type,
-            'available': available,
-            'borrowed_by': None,
-            'borrowed_date': None,
-            'created_at': datetime.now().isoformat()
-        }
-        books.append(book)
-        Book.save_all(books)
-        return book
+        with storage.locked('books.json'):
+            books = Book.load_all()
+            book = {
+                'id': max([b['id'] for b in books], default=0) + 1,
+                'title': title,
+                'author': author,
+                'genre': genre,
+                'period': period,
+                'literature_type': literature_type,
+                'available': available,
+                'borrowed_by': None,
+                'borrowed_date': None,
+                'created_at': datetime.now().isoformat()
+            }
+            books.append(book)
+            Book.save_all(books, changed=[])
+            return book
+    
+    @staticmethod
+    def index_by_id(books):
+        return {book['id']: book for book in books}
+    
+    @staticmethod
+    def load_index():
+        return storage.derive('books.json', Book.index_by_id, default=list)
+    
+    @staticmethod
+    def load_indexed():
+        """(books, index by id) from the same snapshot"""
+        return storage.load_indexed('books.json', Book.index_by_id, default=list)
     
     @staticmethod
     def find_by_id(book_id):
-        books = Book.load_all()
-        for book in books:
-            if book['id'] == book_id:
-                return book
-        return None
+        return Book.load_index().get(book_id)
+    
+    @staticmethod
+    def build_match_index(books):
+        return matching.MatchIndex((b['id'], b['title'], b['author']) for b in books)
+    
+    @staticmethod
+    def find_similar(title, author, threshold=matching.MATCH_SIMILARITY):
+        """The catalog book closest to title/author, or None"""
+        book_id = storage.derive('books.json', Book.build_match_index, default=list).best(title, author, threshold)
+        return Book.find_by_id(book_id) if book_id is not None else None
     
     @staticmethod
     def update(book_id, **kwargs):
-        books = Book.load_all()
-        for book in books:
-            if book['id'] == book_id:
-                book.update(kwargs)
-                Book.save_all(books)
-                return book
-        return None
+        with storage.locked('books.json'):
+            books, index = Book.load_indexed()
+            book = index.get(book_id)
+            if not book:
+                return None
+            book.update(kwargs)
+            Book.save_all(books, changed=[book_id])
+        events.publish_book(book, Hold.get_queue(book_id))
+        return book
+    
+    @staticmethod
+    def delete(book_id):
+        """Delete a book along with its hold queue"""
+        with storage.locked('books.json'):
+            books = Book.load_all()
+            remaining = [b for b in books if b['id'] != book_id]
+            if len(remaining) == len(books):
+                return False
+            Book.save_all(remaining, changed=[])
+            Hold.clear(book_id)
+        events.publish_deleted(book_id)
+        return True
+    
+    @staticmethod
+    def apply_loan_changes(username, changes):
+        """Borrow or return several books for one user with a single write per
+        data file. `changes` is a list of ('borrow' | 'return', book_id); returns
+        a status string per change. Returned books go straight to the next
+        holder if there is one."""
+        with storage.locked('books.json'), storage.locked('holds.json'):
+            books, index = Book.load_indexed()
+            holds = None
+            notifications = []
+            results = []
+            
+            for action, book_id in changes:
+                book = index.get(book_id)
+                if not book:
+                    results.append('not_found')
+                elif action == 'borrow':
+                    if not book['available']:
+                        results.append('unavailable')
+                        continue
+                    book.update(available=False, borrowed_by=username, borrowed_date=datetime.now().isoformat())
+                    results.append('ok')
+                elif action == 'return':
+                    if book['available'] or book['borrowed_by'] != username:
+                        results.append('not_borrowed')
+                        continue
+                    if holds is None:
+                        holds = Hold.load_all()
+                    queue = holds.get(str(book_id))
+                    if queue:
+                        next_holder = queue.pop(0)
+                        if not queue:
+                            del holds[str(book_id)]
+                        book.update(borrowed_by=next_holder, borrowed_date=datetime.now().isoformat())
+                        notifications.append((next_holder, f'Your hold on "{book["title"]}" is ready - the book is now borrowed by you'))
+                    else:
+                        book.update(available=True, borrowed_by=None, borrowed_date=None)
+                    results.append('ok')
+                else:
+                    results.append('invalid')
+            
+            changed = [book_id for (_, book_id), result in zip(changes, results) if result == 'ok']
+            if changed:
+                Book.save_all(books, changed=changed)
+            if holds is not None:
+                Hold.save_all(holds)
+            if notifications:
+                User.notify_many(notifications)
+        borrowers = [username for (action, _), result in zip(changes, results) if action == 'borrow' and result == 'ok']
+        borrowers += [holder for holder, _ in notifications]
+        if borrowers:
+            # Recorded in the background like logins and downloads; imported
+            # here because app.jobs imports this module
+            from app import jobs
+            jobs.enqueue('track_borrows', usernames=borrowers, timestamp=datetime.now().isoformat())
+        for book_id in changed:
+            events.publish_book(Book.find_by_id(book_id), Hold.get_queue(book_id))
+        return results
     
     @staticmethod
     def borrow(book_id, username):
-        book = Book.find_by_id(book_id)
-        if book and book['available']:
-            book['available'] = False
-            book['borrowed_by'] = username
-            book['borrowed_date'] = datetime.now().isoformat()
-            Book.update(book_id, available=False, borrowed_by=username, borrowed_date=book['borrowed_date'])
-            return True
-        return False
+        return Book.apply_loan_changes(username, [('borrow', book_id)])[0] == 'ok'
     
     @staticmethod
     def return_book(book_id):
+        """Return a book, handing it straight to the next holder if there is one"""
         book = Book.find_by_id(book_id)
         if book and not book['available']:
-            Book.update(book_id, available=True, borrowed_by=None, borrowed_date=None)
-            return True
+            return Book.apply_loan_changes(book['borrowed_by'], [('return', book_id)])[0] == 'ok'
         return False
     
     @staticmethod
@@ -246,128 +400,293 @@ Downloaded from Library System
         return content
 
 
+class Hold:
+    """FIFO hold queues for borrowed books, keyed by book id"""
+    
+    @staticmethod
+    def load_all():
+        return storage.load('holds.json', default=dict)
+    
+    @staticmethod
+    def save_all(holds):
+        storage.save('holds.json', holds)
+    
+    @staticmethod
+    def get_queue(book_id):
+        return Hold.load_all().get(str(book_id), [])
+    
+    @staticmethod
+    def position(book_id, username):
+        """1-based position of the user in the book's queue, or None"""
+        queue = Hold.get_queue(book_id)
+        if username in queue:
+            return queue.index(username) + 1
+        return None
+    
+    @staticmethod
+    def place(book_id, username):
+        """Add the user to the end of the queue and return their position"""
+        with storage.locked('holds.json'):
+            holds = Hold.load_all()
+            queue = holds.get(str(book_id), [])
+            if username in queue:
+                return None
+            holds[str(book_id)] = queue + [username]
+            Hold.save_all(holds)
+        Hold.publish(book_id, holds[str(book_id)])
+        return len(queue) + 1
+    
+    @staticmethod
+    def cancel(book_id, username):
+        with storage.locked('holds.json'):
+            holds = Hold.load_all()
+            queue = holds.get(str(book_id), [])
+            if username not in queue:
+                return False
+            queue.remove(username)
+            if not queue:
+                del holds[str(book_id)]
+            Hold.save_all(holds)
+        Hold.publish(book_id, queue)
+        return True
+    
+    @staticmethod
+    def clear(book_id):
+        with storage.locked('holds.json'):
+            holds = Hold.load_all()
+            if holds.pop(str(book_id), None) is not None:
+                Hold.save_all(holds)
+    
+    @staticmethod
+    def publish(book_id, queue):
+        book = Book.find_by_id(book_id)
+        if book:
+            events.publish_book(book, queue)
+
+
 class BookRequest:
     @staticmethod
     def load_all():
-        requests_file = os.path.join(DATA_DIR, 'book_requests.json')
-        if not os.path.exists(requests_file):
-            return []
-        with open(requests_file, 'r') as f:
-            return json.load(f)
+        return storage.load('book_requests.json', default=list)
     
     @staticmethod
-    def save_all(requests):
-        requests_file = os.path.join(DATA_DIR, 'book_requests.json')
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(requests_file, 'w') as f:
-            json.dump(requests, f, indent=2)
+    def save_all(requests, changed=None):
+        storage.save('book_requests.json', requests, changed=changed)
     
     @staticmethod
     def create(username, title, author, reason=''):
-        requests = BookRequest.load_all()
-        request = {
-            'id': max([r['id'] for r in requests], default=0) + 1,
-            'username': username,
-            'title': title,
-            'author': author,
-            'reason': reason,
-            'status': 'pending',
-            'created_at': datetime.now().isoformat()
-        }
-        requests.append(request)
-        BookRequest.save_all(requests)
-        return request
+        with storage.locked('book_requests.json'):
+            requests = BookRequest.load_all()
+            request = {
+                'id': max([r['id'] for r in requests], default=0) + 1,
+                'username': username,
+                'requesters': [username],
+                'title': title,
+                'author': author,
+                'reason': reason,
+                'status': 'pending',
+                'created_at': datetime.now().isoformat()
+            }
+            requests.append(request)
+            BookRequest.save_all(requests, changed=[])
+            return request
+    
+    @staticmethod
+    def requesters(req):
+        return req.get('requesters') or [req['username']]
+    
+    @staticmethod
+    def submit(username, title, author, reason=''):
+        """Request a book unless it is already in the catalog or requested.
+        
+        Returns (outcome, record): ('in_catalog', book), ('already_requested',
+        request) if this user already asked for it, ('merged', request) when
+        the user was added to an open request for the same book, or
+        ('created', request)."""
+        book = Book.find_similar(title, author, matching.SAME_SIMILARITY)
+        if book:
+            return 'in_catalog', book
+        with storage.locked('book_requests.json'):
+            match = BookRequest.find_similar(title, author, matching.SAME_SIMILARITY)
+            if not match:
+                return 'created', BookRequest.create(username, title, author, reason)
+            requesters = BookRequest.requesters(match)
+            if username in requesters:
+                return 'already_requested', match
+            requests, index = BookRequest.load_indexed()
+            req = index[match['id']]
+            req['requesters'] = requesters + [username]
+            if reason and not req['reason']:
+                req['reason'] = reason
+            BookRequest.save_all(requests, changed=[req['id']])
+            return 'merged', req
+    
+    @staticmethod
+    def index_by_id(requests):
+        return {req['id']: req for req in requests}
+    
+    @staticmethod
+    def load_index():
+        return storage.derive('book_requests.json', BookRequest.index_by_id, default=list)
+    
+    @staticmethod
+    def load_indexed():
+        """(requests, index by id) from the same snapshot"""
+        return storage.load_indexed('book_requests.json', BookRequest.index_by_id, default=list)
     
     @staticmethod
     def find_by_id(request_id):
-        requests = BookRequest.load_all()
-        for req in requests:
-            if req['id'] == request_id:
-                return req
-        return None
+        return BookRequest.load_index().get(request_id)
     
     @staticmethod
-    def update_status(request_id, status):
-        requests = BookRequest.load_all()
+    def index_by_status(requests):
+        index = {}
         for req in requests:
-            if req['id'] == request_id:
-                req['status'] = status
+            index.setdefault(req['status'], []).append(req)
+        return index
+    
+    @staticmethod
+    def find_by_status(status):
+        return storage.derive('book_requests.json', BookRequest.index_by_status, default=list).get(status, [])
+    
+    @staticmethod
+    def build_match_index(requests):
+        return matching.MatchIndex((r['id'], r['title'], r['author']) for r in requests if r['status'] == 'pending')
+    
+    @staticmethod
+    def find_all_similar(title, author, threshold=matching.MATCH_SIMILARITY):
+        """Pending requests similar to title/author, closest first"""
+        index = storage.derive('book_requests.json', BookRequest.build_match_index, default=list)
+        return [BookRequest.find_by_id(request_id) for _, request_id in index.find(title, author, threshold)]
+    
+    @staticmethod
+    def find_similar(title, author, threshold=matching.MATCH_SIMILARITY):
+        similar = BookRequest.find_all_similar(title, author, threshold)
+        return similar[0] if similar else None
+    
+    @staticmethod
+    def approve(request_id, also=()):
+        """Approve a pending request, together with any duplicates of it and
+        the near-duplicates in `also` picked by an admin (other ids are
+        ignored).
+        
+        The book is only added if the catalog has no copy of it yet. Returns
+        (book, added, approved_count), or None if the request is not pending."""
+        with storage.locked('book_requests.json'):
+            requests, index = BookRequest.load_indexed()
+            req = index.get(request_id)
+            if not req or req['status'] != 'pending':
+                return None
+            book = Book.find_similar(req['title'], req['author'], matching.SAME_SIMILARITY)
+            added = book is None
+            if added:
+                book = Book.create(req['title'], req['author'], 'User Requested', 'Unknown')
+            
+            duplicates = {r['id'] for r in BookRequest.find_all_similar(req['title'], req['author'], matching.SAME_SIMILARITY)}
+            duplicates.add(request_id)
+            # Only near-duplicates of this request may be approved along with it
+            similar = {r['id'] for r in BookRequest.find_all_similar(req['title'], req['author'], matching.MATCH_SIMILARITY)}
+            duplicates.update(similar & set(also))
+            for r in requests:
+                if r['id'] in duplicates:
+                    r['status'] = 'approved'
+                    r['book_id'] = book['id']
+            BookRequest.save_all(requests, changed=sorted(duplicates))
+            return book, added, len(duplicates)
+    
+    @staticmethod
+    def expire_stale(days):
+        """Mark pending requests older than `days` as expired"""
+        cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+        with storage.locked('book_requests.json'):
+            requests = BookRequest.load_all()
+            expired = 0
+            for req in requests:
+                if req['status'] == 'pending' and req['created_at'] < cutoff:
+                    req['status'] = 'expired'
+                    expired += 1
+            if expired:
                 BookRequest.save_all(requests)
-                return req
-        return None
+            return expired
+    
+    @staticmethod
+    def update_status(request_id, status):
+        with storage.locked('book_requests.json'):
+            requests, index = BookRequest.load_indexed()
+            req = index.get(request_id)
+            if not req:
+                return None
+            req['status'] = status
+            BookRequest.save_all(requests, changed=[request_id])
+            return req
 
 
 class Stats:
     @staticmethod
     def get_stats_file():
-        return os.path.join(DATA_DIR, 'stats.json')
+        return storage.get_path('stats.json')
+    
+    @staticmethod
+    def empty_stats():
+        return {
+            'total_visitors': 0,
+            'e_book_downloads': 0,
+            'last_updated': datetime.now().isoformat()
+        }
     
     @staticmethod
     def load_stats():
-        stats_file = Stats.get_stats_file()
-        if not os.path.exists(stats_file):
-            return {
-                'total_visitors': 0,
-                'monthly_visits': {},
-                'e_book_downloads': 0,
-                'last_updated': datetime.now().isoformat()
-            }
         try:
-            with open(stats_file, 'r') as f:
-                return json.load(f)
+            return storage.load('stats.json', default=Stats.empty_stats)
         except:
-            return {
-                'total_visitors': 0,
-                'monthly_visits': {},
-                'e_book_downloads': 0,
-                'last_updated': datetime.now().isoformat()
-            }
+            return Stats.empty_stats()
     
     @staticmethod
     def save_stats(stats):
-        stats_file = Stats.get_stats_file()
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(stats_file, 'w') as f:
-            json.dump(stats, f, indent=2)
+        storage.save('stats.json', stats)
     
     @staticmethod
-    def track_visitor(username):
+    def track_visitor(username, timestamp=None):
         """Track a visitor login"""
-        stats = Stats.load_stats()
-        current_month = datetime.now().strftime('%Y-%m')
-        
-        if current_month not in stats['monthly_visits']:
-            stats['monthly_visits'][current_month] = []
-        
-        visitor = {
-            'username': username,
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        if visitor not in stats['monthly_visits'][current_month]:
-            stats['monthly_visits'][current_month].append(visitor)
-        
-        stats['last_updated'] = datetime.now().isoformat()
-        Stats.save_stats(stats)
+        analytics.record('logins', username, timestamp)
+    
+    @staticmethod
+    def track_borrows(usernames, timestamp=None):
+        """Track borrows, including books handed over to the next holder"""
+        analytics.record_many([('borrows', username, timestamp) for username in usernames])
     
     @staticmethod
-    def track_e_book_download():
+    def track_e_book_download(username=None, timestamp=None):
         """Track an e-book download"""
-        stats = Stats.load_stats()
-        stats['e_book_downloads'] = stats.get('e_book_downloads', 0) + 1
-        stats['last_updated'] = datetime.now().isoformat()
-        Stats.save_stats(stats)
+        with storage.locked('stats.json'):
+            stats = Stats.load_stats()
+            stats['e_book_downloads'] = stats.get('e_book_downloads', 0) + 1
+            stats['last_updated'] = datetime.now().isoformat()
+            Stats.save_stats(stats)
+        analytics.record('downloads', username, timestamp)
+    
+    @staticmethod
+    def compact_stats():
+        """Fold raw visit lists left by older versions into the analytics
+        rollups, and drop rollup buckets past their retention"""
+        # Fold into analytics before taking the stats lock (analytics comes
+        # first in the lock order); the job queue runs one compaction at a time
+        visits = Stats.load_stats().get('monthly_visits')
+        if visits:
+            analytics.record_many([
+                ('logins', v['username'], v['timestamp'])
+                for month in visits.values() for v in month for _ in range(v.get('visits', 1))
+            ])
+            with storage.locked('stats.json'):
+                stats = Stats.load_stats()
+                stats.pop('monthly_visits', None)
+                Stats.save_stats(stats)
+        analytics.prune()
     
     @staticmethod
     def get_current_month_visitors():
         """Get number of unique visitors in current month"""
-        stats = Stats.load_stats()
-        current_month = datetime.now().strftime('%Y-%m')
-        visitors = stats['monthly_visits'].get(current_month, [])
-        
-        # Get unique usernames
-        unique_visitors = list(set([v['username'] for v in visitors]))
-        return len(unique_visitors)
+        return analytics.unique_visitors(period='month')
     
     @staticmethod
     def get_borrowed_books_count():
@@ -397,4 +716,20 @@ class Stats:
             'e_book_downloads': stats.get('e_book_downloads', 0),
             'last_updated': stats.get('last_updated', 'Never')
         }
-
+    
+    @staticmethod
+    def refresh_cached_dashboard_stats():
+        """Precompute dashboard stats so pages can read them without scanning"""
+        dashboard = Stats.get_dashboard_stats()
+        with storage.locked('stats.json'):
+            stats = Stats.load_stats()
+            stats['dashboard'] = dashboard
+            stats['dashboard_updated'] = datetime.now().isoformat()
+            Stats.save_stats(stats)
+        return dashboard
+    
+    @staticmethod
+    def get_cached_dashboard_stats():
+        """Return the last precomputed dashboard stats, computing them if missing"""
+        stats = Stats.load_stats()
+        return stats.get('dashboard') or Stats.get_dashboard_stats()
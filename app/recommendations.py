@@ -0,0 +1,122 @@
+"""Recommendations: "readers also saved" suggestions.
+
+Keeps a sparse item-item co-occurrence matrix over the books each user has
+saved (wishlist and maturita list combined), plus a precomputed top-k
+neighbour list per book. The User list methods update both incrementally,
+so serving suggestions is a dictionary lookup rather than a scan over all
+users. The `rebuild_recommendations` job recomputes everything from
+users.json once a day to correct any drift.
+
+recommendations.json holds one entry per book,
+{"7": {"row": {"12": 3, ...}, "neighbors": [[12, 3], ...]}}, so a save
+touches (and WAL mode logs) only the books whose rows changed.
+"""
+import heapq
+
+from app import storage
+
+TOP_K = 10
+GAP_BOOST = 1.0     # extra weight for books in maturita categories still short
+
+
+def load():
+    data = storage.load('recommendations.json', default=dict)
+    if 'cooccurrence' in data:
+        data = migrate()
+    return data
+
+
+def migrate():
+    """Convert the older layout with two whole matrices to one entry per book"""
+    with storage.locked('recommendations.json'):
+        data = storage.load('recommendations.json', default=dict)
+        if 'cooccurrence' in data:
+            data = {book: {'row': row, 'neighbors': top_neighbors(row)} for book, row in data['cooccurrence'].items()}
+            storage.save('recommendations.json', data)
+        return data
+
+
+def index_neighbors(data):
+    return {book: entry['neighbors'] for book, entry in data.items()}
+
+
+def neighbor_map():
+    """{book id (str): [[other id, count], ...]} for every book with neighbours"""
+    load()
+    return storage.derive('recommendations.json', index_neighbors, default=dict)
+
+
+def top_neighbors(row):
+    return [[int(other), count] for other, count in heapq.nlargest(TOP_K, row.items(), key=lambda item: (item[1], -int(item[0])))]
+
+
+def rebuild(users):
+    """Recompute the matrix and neighbour lists from every user's saved books"""
+    cooccurrence = {}
+    for user in users:
+        saved = sorted(set(user.get('wishlist', [])) | set(user.get('maturita_list', [])))
+        for book_id in saved:
+            row = cooccurrence.setdefault(str(book_id), {})
+            for other in saved:
+                if other != book_id:
+                    row[str(other)] = row.get(str(other), 0) + 1
+    data = {book: {'row': row, 'neighbors': top_neighbors(row)} for book, row in cooccurrence.items()}
+    with storage.locked('recommendations.json'):
+        storage.save('recommendations.json', data)
+    return data
+
+
+def record_changes(changes):
+    """Apply (book_id, others, delta) updates with a single write. A delta of
+    +1 means a user who already saved `others` has just saved `book_id`; -1
+    means they dropped it and still have `others` saved."""
+    changes = [change for change in changes if change[1]]
+    if not changes:
+        return
+    with storage.locked('recommendations.json'):
+        data = load()
+        touched = set()
+        for book_id, others, delta in changes:
+            touched.add(str(book_id))
+            for other in others:
+                if other == book_id:
+                    continue
+                for a, b in ((str(book_id), str(other)), (str(other), str(book_id))):
+                    row = data.setdefault(a, {'row': {}, 'neighbors': []})['row']
+                    count = row.get(b, 0) + delta
+                    if count > 0:
+                        row[b] = count
+                    else:
+                        row.pop(b, None)
+                        if not row:
+                            del data[a]
+                touched.add(str(other))
+        for book in touched:
+            if book in data:
+                data[book]['neighbors'] = top_neighbors(data[book]['row'])
+        storage.save('recommendations.json', data, changed=sorted(touched))
+
+
+def similar_books(book_id, limit=5):
+    """Ids of the books most often saved together with `book_id`"""
+    return [other for other, _ in neighbor_map().get(str(book_id), [])[:limit]]
+
+
+def suggest_for_user(saved, books_by_id, limit=5, category_gaps=None):
+    """Rank neighbours of the user's saved books, favouring maturita categories
+    where the user is still short of the minimum"""
+    neighbors = neighbor_map()
+    scores = {}
+    for book_id in saved:
+        for other, count in neighbors.get(str(book_id), []):
+            if other not in saved and other in books_by_id:
+                scores[other] = scores.get(other, 0) + count
+
+    if category_gaps:
+        for other in scores:
+            lit_type = books_by_id[other].get('literature_type') or ''
+            if any(category in lit_type for category in category_gaps):
+                scores[other] *= 1 + GAP_BOOST
+
+    ranked = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+    return [books_by_id[other] for other, _ in ranked]
@@ -1,7 +1,11 @@
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash, send_file
-from app.models import User, Book, BookRequest, Stats
+from flask import Blueprint, Response, current_app, render_template, request, redirect, url_for, session, flash, send_file, jsonify
+from app.models import User, Book, BookRequest, Stats, Hold, MATURITA_CATEGORIES
+from app import jobs, recommendations, events, analytics, matching
+from datetime import datetime
+import csv
 import functools
-import qrcode
+import io
+import json
 from io import BytesIO
 import os
 
@@ -9,8 +13,10 @@ import os
 auth_bp = Blueprint('auth', __name__)
 library_bp = Blueprint('library', __name__)
 admin_bp = Blueprint('admin', __name__)
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
 
 USER_TAGS = ['Student', 'Teacher', 'Librarian', 'Parent', 'Academic', 'Researcher']
+EVENTS_KEEPALIVE = 15    # seconds between comments on an idle event stream
 
 # Login required decorator
 def login_required(f):
@@ -36,6 +42,21 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def api_login_required(f):
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            return jsonify(error='login required'), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+@library_bp.before_app_request
+def flash_notifications():
+    # The event stream never renders flashes, so leave them for the next page
+    if 'username' in session and request.endpoint != 'library.catalog_events':
+        for message in User.pop_notifications(session['username']):
+            flash(message, 'info')
+
 # AUTH ROUTES
 @auth_bp.route('/')
 def index():
@@ -45,7 +66,7 @@ def index():
 
 @library_bp.route('/home')
 def home():
-    stats = Stats.get_dashboard_stats() if 'user_id' in session else None
+    stats = Stats.get_cached_dashboard_stats() if 'user_id' in session else None
     return render_template('home.html', stats=stats)
 
 @auth_bp.route('/signup', methods=['GET', 'POST'])
@@ -81,8 +102,9 @@ def login():
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['is_admin'] = user['is_admin']
-            # Track visitor
-            Stats.track_visitor(username)
+            session['tenant'] = request.environ.get('library.tenant')
+            # Track visitor in the background
+            jobs.enqueue('track_visitor', username=username, timestamp=datetime.now().isoformat())
             flash(f'Welcome back, {username}!', 'success')
             return redirect(url_for('library.catalog'))
         else:
@@ -102,7 +124,33 @@ def logout():
 def catalog():
     books = Book.load_all()
     user = User.find_by_username(session['username'])
-    return render_template('catalog.html', books=books, user=user)
+    holds = Hold.load_all()
+    return render_template('catalog.html', books=books, user=user, holds=holds,
+                           books_by_id=Book.load_index(), neighbors=recommendations.neighbor_map())
+
+@library_bp.route('/catalog/events')
+@login_required
+def catalog_events():
+    """Stream availability changes to an open catalog page (Server-Sent Events)"""
+    if not current_app.config['LIVE_UPDATES']:
+        # 204 tells EventSource to stop reconnecting
+        return '', 204
+    username = session['username']
+    
+    def render(batch):
+        if not batch:
+            return b': keepalive\n\n'
+        return ''.join(
+            f"event: {event['type']}\ndata: {json.dumps(events.for_user(event, username))}\n\n" for event in batch
+        ).encode()
+    
+    response = Response(events.EventStream(events.get_broadcaster(), render, EVENTS_KEEPALIVE),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Hand the EventStream itself to the server, so the ASGI adapter can wait
+    # for events on its loop instead of in a thread
+    response.direct_passthrough = True
+    return response
 
 @library_bp.route('/book/<int:book_id>')
 @login_required
@@ -120,10 +168,12 @@ def borrow_book(book_id):
     if not book:
         flash('Book not found', 'error')
     elif not book['available']:
-        flash('Book is already borrowed', 'error')
-    else:
-        Book.borrow(book_id, session['username'])
+        flash('Book is already borrowed - place a hold to get it next', 'error')
+    elif Book.borrow(book_id, session['username']):
         flash(f'You have borrowed "{book["title"]}"', 'success')
+    else:
+        # Someone else borrowed it in the meantime
+        flash('Book is already borrowed - place a hold to get it next', 'error')
     
     return redirect(url_for('library.catalog'))
 
@@ -137,12 +187,45 @@ def return_book(book_id):
         flash('This book is not borrowed', 'error')
     elif book['borrowed_by'] != session['username']:
         flash('You did not borrow this book', 'error')
-    else:
-        Book.return_book(book_id)
+    elif Book.apply_loan_changes(session['username'], [('return', book_id)])[0] == 'ok':
         flash(f'You have returned "{book["title"]}"', 'success')
+    else:
+        # Already returned, e.g. by a second click; the book may have moved on
+        # to the next holder, so it must not be returned again on their behalf
+        flash('You did not borrow this book', 'error')
     
     return redirect(url_for('library.catalog'))
 
+@library_bp.route('/hold/<int:book_id>', methods=['POST'])
+@login_required
+def place_hold(book_id):
+    book = Book.find_by_id(book_id)
+    if not book:
+        flash('Book not found', 'error')
+    elif book['available']:
+        flash('This book is available - you can borrow it right away', 'info')
+    elif book['borrowed_by'] == session['username']:
+        flash('You already have this book', 'info')
+    else:
+        position = Hold.place(book_id, session['username'])
+        if position:
+            flash(f'Hold placed on "{book["title"]}". You are #{position} in the queue', 'success')
+        else:
+            flash('You already have a hold on this book', 'info')
+    
+    return redirect(request.referrer or url_for('library.catalog'))
+
+@library_bp.route('/hold/<int:book_id>/cancel', methods=['POST'])
+@login_required
+def cancel_hold(book_id):
+    book = Book.find_by_id(book_id)
+    if not book:
+        flash('Book not found', 'error')
+    elif Hold.cancel(book_id, session['username']):
+        flash(f'Hold on "{book["title"]}" cancelled', 'success')
+    
+    return redirect(request.referrer or url_for('library.catalog'))
+
 @library_bp.route('/request-book', methods=['GET', 'POST'])
 @login_required
 def request_book():
@@ -155,8 +238,16 @@ def request_book():
             flash('Title and author are required', 'error')
             return redirect(url_for('library.request_book'))
         
-        BookRequest.create(session['username'], title, author, reason)
-        flash('Book request submitted successfully!', 'success')
+        outcome, record = BookRequest.submit(session['username'], title, author, reason)
+        if outcome == 'in_catalog':
+            flash(f'"{record["title"]}" by {record["author"]} is already in the catalog', 'info')
+        elif outcome == 'already_requested':
+            flash(f'You have already requested "{record["title"]}"', 'info')
+        elif outcome == 'merged':
+            flash(f'"{record["title"]}" has already been requested - your request was added to it '
+                  f'({len(BookRequest.requesters(record))} readers are waiting)', 'success')
+        else:
+            flash('Book request submitted successfully!', 'success')
         return redirect(url_for('library.catalog'))
     
     return render_template('request_book.html')
@@ -213,30 +304,25 @@ def maturita():
     maturita_books = [b for b in books if b['id'] in maturita_ids]
     
     # Calculate progress by category
-    categories = {
-        'world_czech_18': {'min': 2, 'books': []},
-        'world_czech_19': {'min': 3, 'books': []},
-        'world_20_21': {'min': 4, 'books': []},
-        'czech_20_21': {'min': 5, 'books': []}
-    }
+    categories = {name: {'min': minimum, 'books': []} for name, minimum in MATURITA_CATEGORIES.items()}
     
     for book in maturita_books:
-        lit_type = book.get('literature_type', '')
-        if 'world_czech_18' in lit_type:
-            categories['world_czech_18']['books'].append(book)
-        if 'world_czech_19' in lit_type:
-            categories['world_czech_19']['books'].append(book)
-        if 'world_20_21' in lit_type:
-            categories['world_20_21']['books'].append(book)
-        if 'czech_20_21' in lit_type:
-            categories['czech_20_21']['books'].append(book)
+        lit_type = book.get('literature_type') or ''
+        for name, category in categories.items():
+            if name in lit_type:
+                category['books'].append(book)
     
     # Calculate overall progress
     total_required = 20
     total_progress = len(maturita_books)
     
+    # Suggest books co-saved by other readers, favouring unfinished categories
+    gaps = [name for name, category in categories.items() if len(category['books']) < category['min']]
+    suggestions = recommendations.suggest_for_user(User.saved_books(user), Book.load_index(), category_gaps=gaps)
+    
     return render_template('maturita.html', books=maturita_books, categories=categories, 
-                         total_progress=total_progress, total_required=total_required)
+                         total_progress=total_progress, total_required=total_required,
+                         suggestions=suggestions)
 
 @library_bp.route('/maturita/add/<int:book_id>', methods=['POST'])
 @login_required
@@ -278,8 +364,8 @@ def borrow_electronic(book_id):
         flash('Could not generate book file', 'error')
         return redirect(url_for('library.catalog'))
     
-    # Track e-book download
-    Stats.track_e_book_download()
+    # Track e-book download in the background
+    jobs.enqueue('track_e_book_download', username=session['username'], timestamp=datetime.now().isoformat())
     
     # Create a BytesIO object to send as file
     file = BytesIO(content.encode('utf-8'))
@@ -303,11 +389,14 @@ def borrow_physical(book_id):
         flash('Book not found', 'error')
         return redirect(url_for('library.catalog'))
     
-    if not book['available']:
-        flash('Book is already borrowed', 'error')
+    # Mark book as borrowed; the check above can lose a race with another reader
+    if not book['available'] or not Book.borrow(book_id, session['username']):
+        flash('Book is already borrowed - place a hold to get it next', 'error')
         return redirect(url_for('library.catalog'))
     
-    # Generate QR code with borrowing info
+    # Generate QR code with borrowing info. qrcode pulls in PIL, so it is
+    # imported here rather than slowing down every worker's startup
+    import qrcode
     qr_data = f"LIBRARY_BORROW|book_id:{book_id}|user:{session['username']}|title:{book['title']}"
     
     qr = qrcode.QRCode(
@@ -326,8 +415,6 @@ def borrow_physical(book_id):
     img.save(img_io, 'PNG')
     img_io.seek(0)
     
-    # Mark book as borrowed
-    Book.borrow(book_id, session['username'])
     flash(f'Physical borrow initiated for "{book["title"]}". Bring the QR code to the library!', 'success')
     
     filename = f"borrow_qr_{book_id}_{session['username']}.png"
@@ -339,14 +426,129 @@ def borrow_physical(book_id):
     )
 
 # ADMIN ROUTES
+BOOK_SORT_KEYS = {
+    'id': lambda b: b['id'],
+    'title': lambda b: b['title'].lower(),
+    'author': lambda b: b['author'].lower(),
+    'genre': lambda b: (b.get('genre') or '').lower(),
+    'period': lambda b: (b.get('period') or '').lower(),
+    'status': lambda b: b['available'],
+}
+
+REQUEST_SORT_KEYS = {
+    'created_at': lambda r: r['created_at'],
+    'requesters': lambda r: (len(BookRequest.requesters(r)), r['created_at']),
+}
+
+def paginate(items):
+    """Slice a list using the page/per_page query args"""
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 25, type=int), 1), 100)
+    total = len(items)
+    return items[(page - 1) * per_page:page * per_page], {
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'pages': max((total + per_page - 1) // per_page, 1)
+    }
+
 @admin_bp.route('/admin')
 @admin_required
 def admin_dashboard():
-    books = Book.load_all()
-    requests = BookRequest.load_all()
-    pending_requests = [r for r in requests if r['status'] == 'pending']
+    pending_count = len(BookRequest.find_by_status('pending'))
     stats = Stats.get_dashboard_stats()
-    return render_template('admin_dashboard.html', books=books, pending_requests=pending_requests, stats=stats)
+    return render_template('admin_dashboard.html', pending_count=pending_count, stats=stats)
+
+@admin_bp.route('/admin/api/books')
+@admin_required
+def admin_books_json():
+    books = Book.load_all()
+    query = request.args.get('q', '').strip().lower()
+    if query:
+        books = [b for b in books if query in b['title'].lower() or query in b['author'].lower()]
+    sort = request.args.get('sort', 'id')
+    books = sorted(books, key=BOOK_SORT_KEYS.get(sort, BOOK_SORT_KEYS['id']),
+                   reverse=request.args.get('order') == 'desc')
+    page, meta = paginate(books)
+    meta['items'] = [{
+        'id': b['id'],
+        'title': b['title'],
+        'author': b['author'],
+        'genre': b['genre'],
+        'period': b['period'],
+        'available': b['available'],
+        'edit_url': url_for('admin.edit_book', book_id=b['id']),
+        'delete_url': url_for('admin.delete_book', book_id=b['id'])
+    } for b in page]
+    return jsonify(meta)
+
+@admin_bp.route('/admin/api/requests')
+@admin_required
+def admin_requests_json():
+    requests = BookRequest.find_by_status(request.args.get('status', 'pending'))
+    sort_key = REQUEST_SORT_KEYS.get(request.args.get('sort'), REQUEST_SORT_KEYS['created_at'])
+    requests = sorted(requests, key=sort_key, reverse=request.args.get('order') == 'desc')
+    page, meta = paginate(requests)
+    meta['items'] = []
+    for r in page:
+        similar = Book.find_similar(r['title'], r['author']) if r['status'] == 'pending' else None
+        # Close enough to be worth a look but not merged automatically
+        similar_requests = [
+            other for other in BookRequest.find_all_similar(r['title'], r['author'], matching.MATCH_SIMILARITY)
+            if other['id'] != r['id']
+        ] if r['status'] == 'pending' else []
+        meta['items'].append({
+            'id': r['id'],
+            'username': r['username'],
+            'requesters': len(BookRequest.requesters(r)),
+            'title': r['title'],
+            'author': r['author'],
+            'reason': r['reason'],
+            'status': r['status'],
+            'created_at': r['created_at'],
+            'similar_book': {'id': similar['id'], 'title': similar['title'], 'author': similar['author']} if similar else None,
+            'similar_requests': [
+                {'id': other['id'], 'title': other['title'], 'author': other['author'], 'requesters': len(BookRequest.requesters(other))}
+                for other in similar_requests
+            ],
+            'approve_url': url_for('admin.approve_request', request_id=r['id']),
+            'reject_url': url_for('admin.reject_request', request_id=r['id'])
+        })
+    return jsonify(meta)
+
+ANALYTICS_DEFAULT_LIMITS = {'day': 30, 'week': 26, 'month': 12}
+
+def analytics_series():
+    """Rollup rows for the period/limit query args"""
+    period = request.args.get('period', 'day')
+    if period not in analytics.PERIODS:
+        period = 'day'
+    limit = min(max(request.args.get('limit', ANALYTICS_DEFAULT_LIMITS[period], type=int), 1), analytics.RETENTION['day'])
+    return period, analytics.series(period, limit)
+
+@admin_bp.route('/admin/analytics')
+@admin_required
+def admin_analytics():
+    return render_template('admin_analytics.html',
+                           visitors_7=analytics.unique_visitors(days=7),
+                           visitors_30=analytics.unique_visitors(days=30))
+
+@admin_bp.route('/admin/api/analytics')
+@admin_required
+def admin_analytics_json():
+    period, rows = analytics_series()
+    return jsonify(period=period, metrics=list(analytics.METRICS) + ['visitors'], rows=rows)
+
+@admin_bp.route('/admin/analytics.csv')
+@admin_required
+def admin_analytics_csv():
+    period, rows = analytics_series()
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=['bucket', *analytics.METRICS, 'visitors'])
+    writer.writeheader()
+    writer.writerows(rows)
+    return Response(out.getvalue(), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename=library_{period}_analytics.csv'})
 
 @admin_bp.route('/admin/add-book', methods=['GET', 'POST'])
 @admin_required
@@ -398,20 +600,20 @@ def edit_book(book_id):
 @admin_bp.route('/admin/delete-book/<int:book_id>', methods=['POST'])
 @admin_required
 def delete_book(book_id):
-    books = Book.load_all()
-    books = [b for b in books if b['id'] != book_id]
-    Book.save_all(books)
+    Book.delete(book_id)
     flash('Book deleted successfully!', 'success')
     return redirect(url_for('admin.admin_dashboard'))
 
 @admin_bp.route('/admin/request/<int:request_id>/approve', methods=['POST'])
 @admin_required
 def approve_request(request_id):
-    book_req = BookRequest.find_by_id(request_id)
-    if book_req:
-        Book.create(book_req['title'], book_req['author'], 'User Requested', 'Unknown')
-        BookRequest.update_status(request_id, 'approved')
-        flash(f'Request approved and book added!', 'success')
+    result = BookRequest.approve(request_id, also=request.form.getlist('merge', type=int))
+    if result:
+        book, added, approved = result
+        message = 'Request approved and book added!' if added else f'Request approved - "{book["title"]}" is already in the catalog'
+        if approved > 1:
+            message += f' ({approved - 1} duplicate request(s) approved with it)'
+        flash(message, 'success')
     return redirect(url_for('admin.admin_dashboard'))
 
 @admin_bp.route('/admin/request/<int:request_id>/reject', methods=['POST'])
@@ -420,3 +622,74 @@ def reject_request(request_id):
     BookRequest.update_status(request_id, 'rejected')
     flash('Request rejected', 'success')
     return redirect(url_for('admin.admin_dashboard'))
+
+# API ROUTES
+API_LIST_OPS = {
+    'wishlist.add': ('wishlist', 'add'),
+    'wishlist.remove': ('wishlist', 'remove'),
+    'maturita.add': ('maturita_list', 'add'),
+    'maturita.remove': ('maturita_list', 'remove'),
+}
+API_LOAN_OPS = {'borrow', 'return'}
+API_MAX_OPS = 100
+
+def api_user_state(username):
+    user = User.find_by_username(username)
+    return {
+        'wishlist': user.get('wishlist', []),
+        'maturita_list': user.get('maturita_list', []),
+        'borrowed': [b['id'] for b in Book.load_all() if b['borrowed_by'] == username]
+    }
+
+@api_bp.route('/me')
+@api_login_required
+def api_me():
+    return jsonify(username=session['username'], **api_user_state(session['username']))
+
+@api_bp.route('/batch', methods=['POST'])
+@api_login_required
+def api_batch():
+    """Apply many list/borrow operations with one write per data file.
+    
+    Body: {"ops": [{"op": "wishlist.add", "book_id": 3}, {"op": "borrow", "book_id": 5}]}
+    Ops: wishlist.add, wishlist.remove, maturita.add, maturita.remove, borrow, return
+    """
+    payload = request.get_json(silent=True) or {}
+    ops = payload.get('ops')
+    if not isinstance(ops, list) or not ops:
+        return jsonify(error='ops must be a non-empty list'), 400
+    if len(ops) > API_MAX_OPS:
+        return jsonify(error=f'at most {API_MAX_OPS} ops per batch'), 400
+    
+    username = session['username']
+    books_by_id = Book.load_index()
+    results = [None] * len(ops)
+    list_changes, list_slots = [], []
+    loan_changes, loan_slots = [], []
+    
+    for i, op in enumerate(ops):
+        name = op.get('op') if isinstance(op, dict) else None
+        book_id = op.get('book_id') if isinstance(op, dict) else None
+        if not isinstance(book_id, int) or isinstance(book_id, bool):
+            results[i] = 'invalid'
+        elif name in API_LIST_OPS:
+            if book_id not in books_by_id:
+                results[i] = 'not_found'
+            else:
+                list_changes.append((*API_LIST_OPS[name], book_id))
+                list_slots.append(i)
+        elif name in API_LOAN_OPS:
+            loan_changes.append((name, book_id))
+            loan_slots.append(i)
+        else:
+            results[i] = 'invalid'
+    
+    if list_changes:
+        for slot, changed in zip(list_slots, User.apply_list_changes(username, list_changes)):
+            results[slot] = 'ok' if changed else 'unchanged'
+    if loan_changes:
+        for slot, status in zip(loan_slots, Book.apply_loan_changes(username, loan_changes)):
+            results[slot] = status
+    
+    return jsonify(results=results, **api_user_state(username))
+
@@ -0,0 +1,213 @@
+"""JSON file storage shared by the models.
+
+All reads and writes of files in the data directory go through here, so the
+way data is persisted can change without touching the models.
+
+Loaded files are cached per process and revalidated with a stat() on every
+load: a file replaced by another worker gets a new inode/mtime and is
+re-read, everything else is served from memory. Cached data is shared, so
+callers must not mutate what load() returns unless they save it afterwards.
+
+With LIBRARY_STORAGE_MODE=wal, saves are appended to a write-ahead log
+instead (see app/wal.py).
+
+In a multi-library deployment each request runs with its library's data
+directory (see app/tenants.py). Caches, locks and WAL stores are keyed by
+path, so libraries never share state.
+"""
+import contextvars
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+DATA_DIR = os.environ.get('LIBRARY_DATA_DIR') or os.path.join(os.path.dirname(__file__), '..', 'data')
+STORAGE_MODE = os.environ.get('LIBRARY_STORAGE_MODE', 'files')
+
+_data_dir = contextvars.ContextVar('library_data_dir', default=None)
+_cache = {}
+_derived = {}
+_locks = {}
+_locks_guard = threading.Lock()
+_held = threading.local()
+_wal_stores = {}
+
+
+def get_data_dir():
+    """Data directory of the current library (DATA_DIR outside a tenant)"""
+    return _data_dir.get() or DATA_DIR
+
+
+@contextmanager
+def use_data_dir(path):
+    """Run a block against another data directory (None means DATA_DIR)"""
+    token = _data_dir.set(path)
+    try:
+        yield
+    finally:
+        _data_dir.reset(token)
+
+
+def get_wal_store():
+    data_dir = get_data_dir()
+    with _locks_guard:
+        if data_dir not in _wal_stores:
+            from app.wal import WALStore
+            _wal_stores[data_dir] = WALStore(data_dir)
+        store = _wal_stores[data_dir]
+    if store.pid != os.getpid():
+        # Its checkpoint thread did not survive the fork, and the parent may
+        # still be writing the same log
+        raise RuntimeError('WAL store was opened before forking; open it in the worker process')
+    return store
+
+
+def get_path(name):
+    return os.path.join(get_data_dir(), name)
+
+
+def _signature(stat):
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _load(name, default=None):
+    """(signature, data) of a file, both taken from the same read"""
+    if STORAGE_MODE == 'wal':
+        return get_wal_store().load_versioned(name, default)
+    path = get_path(name)
+    try:
+        signature = _signature(os.stat(path))
+    except FileNotFoundError:
+        _cache.pop(path, None)
+        return None, default() if default else None
+
+    cached = _cache.get(path)
+    if cached and cached[0] == signature:
+        return cached
+
+    with open(path, 'r') as f:
+        signature = _signature(os.fstat(f.fileno()))
+        data = json.load(f)
+    _cache[path] = (signature, data)
+    return signature, data
+
+
+def load(name, default=None):
+    """Load a JSON file, returning `default()` if it does not exist"""
+    return _load(name, default)[1]
+
+
+def save(name, data, changed=None):
+    """Write a JSON file atomically so a crash never leaves it half-written.
+
+    For lists of records, `changed` may list the ids of records modified in
+    place (for dicts, the keys); WAL mode then logs only those (plus added
+    and removed ones) instead of diffing every record. It is ignored in
+    file mode.
+    """
+    if STORAGE_MODE == 'wal':
+        store = get_wal_store()
+        batch = store.write(name, data, changed)
+        if batch is None:
+            return
+        if getattr(_held, 'paths', None):
+            # Wait for the fsync once the outermost locked() has released,
+            # so writers queued behind the lock can share it
+            _held.unsynced.append((store, batch))
+        else:
+            store.sync(batch)
+        return
+    path = get_path(name)
+    data_dir = os.path.dirname(path)
+    os.makedirs(data_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=data_dir, prefix=f'.{name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            signature = _signature(os.fstat(f.fileno()))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    _cache[path] = (signature, data)
+
+
+def load_indexed(name, builder, default=None):
+    """Return (data, builder(data)) from one snapshot of the file.
+
+    Mutators use this to look records up in the very list they are about to
+    save; load() and derive() called separately may see different versions
+    if another thread or process saves in between.
+    """
+    signature, data = _load(name, default)
+    if signature is None:
+        return data, builder(data)
+
+    key = (get_path(name), builder)
+    hit = _derived.get(key)
+    if hit and hit[0] == signature and hit[1] is data:
+        return data, hit[2]
+    value = builder(data)
+    _derived[key] = (signature, data, value)
+    return data, value
+
+
+def derive(name, builder, default=None):
+    """Return builder(load(name)), rebuilt only when the file changes.
+
+    Used for lookup indexes over a data file; `builder` must be a stable
+    function object since it is part of the cache key.
+    """
+    return load_indexed(name, builder, default)[1]
+
+
+@contextmanager
+def locked(name):
+    """Serialise read-modify-write cycles on a file across threads and processes.
+
+    Re-entrant within a thread, so a locked mutator can call another one on
+    the same file. Nested locks on different files must be taken in a fixed
+    order (see app/models.py) to avoid deadlocks.
+
+    In WAL mode saves made under the lock are made durable when the
+    outermost lock is released, and no file lock is taken: the WAL store
+    already holds the data directory for this process alone.
+    """
+    path = get_path(name)
+    held = _held.__dict__.setdefault('paths', set())
+    if path in held:
+        yield
+        return
+    outermost = not held
+    if outermost:
+        _held.unsynced = []
+    with _locks_guard:
+        lock = _locks.setdefault(path, threading.Lock())
+    try:
+        with lock:
+            held.add(path)
+            try:
+                if fcntl is None or STORAGE_MODE == 'wal':
+                    yield
+                    return
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(f'{path}.lock', 'a') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+            finally:
+                held.discard(path)
+    finally:
+        if outermost:
+            unsynced, _held.unsynced = _held.unsynced, []
+            for store, batch in unsynced:
+                store.sync(batch)
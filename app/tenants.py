@@ -0,0 +1,128 @@
+"""Serving several libraries from one deployment.
+
+Each library (tenant) keeps its data in its own directory under
+TENANTS_DIR, e.g. data/tenants/kepler/. The tenant is chosen per request,
+either by subdomain (kepler.library.example.com) or by path prefix
+(/kepler/catalog), and the whole request then runs against that directory:
+storage caches, file locks, the WAL store, the job queue and the live event
+feed are all per directory, so libraries never share state or locks.
+
+A deployment can be limited to some tenants with TENANTS (LIBRARY_TENANTS,
+comma separated). Busy libraries can then get their own processes or nodes,
+with a proxy routing each subdomain or prefix to the deployment serving it.
+"""
+import os
+import re
+
+from flask import request
+from flask.sessions import SecureCookieSessionInterface
+from werkzeug.exceptions import NotFound
+
+from app import storage
+
+TENANT_NAME = re.compile(r'^[a-z0-9][a-z0-9-]{0,62}$')
+
+
+def default_root():
+    return os.environ.get('LIBRARY_TENANTS_DIR') or os.path.join(storage.DATA_DIR, 'tenants')
+
+
+def config_from_env():
+    """Default tenant settings for create_app()"""
+    allowed = [name.strip() for name in os.environ.get('LIBRARY_TENANTS', '').split(',') if name.strip()]
+    return {
+        'TENANT_MODE': os.environ.get('LIBRARY_TENANT_MODE') or None,
+        'TENANT_DOMAIN': os.environ.get('LIBRARY_TENANT_DOMAIN'),
+        'TENANTS_DIR': default_root(),
+        'TENANTS': allowed or None,
+    }
+
+
+class TenantRegistry:
+    def __init__(self, root, allowed=None):
+        self.root = root
+        self.allowed = set(allowed) if allowed else None
+
+    def names(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            name for name in os.listdir(self.root)
+            if self.data_dir(name) is not None
+        )
+
+    def data_dir(self, name):
+        """Data directory for a tenant, or None if it is not served here"""
+        if not name or not TENANT_NAME.match(name):
+            return None
+        if self.allowed is not None and name not in self.allowed:
+            return None
+        path = os.path.join(self.root, name)
+        return path if os.path.isdir(path) else None
+
+    def data_dirs(self):
+        return [os.path.join(self.root, name) for name in self.names()]
+
+
+class TenantMiddleware:
+    """Pick the tenant for each request and run the app in its data directory.
+
+    In path mode the prefix is moved from PATH_INFO to SCRIPT_NAME, so routes
+    stay unchanged and url_for() generates prefixed links.
+    """
+
+    def __init__(self, wsgi_app, registry, mode, domain=None):
+        if mode not in ('subdomain', 'path'):
+            raise ValueError(f'Unknown tenant mode: {mode}')
+        if mode == 'subdomain' and not domain:
+            raise ValueError('TENANT_DOMAIN is required for subdomain tenants')
+        self.wsgi_app = wsgi_app
+        self.registry = registry
+        self.mode = mode
+        self.domain = domain.lower() if domain else None
+
+    def tenant_name(self, environ):
+        if self.mode == 'path':
+            name, _, rest = environ.get('PATH_INFO', '').lstrip('/').partition('/')
+            environ['SCRIPT_NAME'] = f"{environ.get('SCRIPT_NAME', '').rstrip('/')}/{name}"
+            environ['PATH_INFO'] = f'/{rest}'
+            return name
+        host = environ.get('HTTP_HOST', environ.get('SERVER_NAME', '')).split(':')[0].lower()
+        if host.endswith(f'.{self.domain}'):
+            return host[:-len(self.domain) - 1]
+        return None
+
+    def __call__(self, environ, start_response):
+        name = self.tenant_name(environ)
+        data_dir = self.registry.data_dir(name)
+        if data_dir is None:
+            return NotFound('Unknown library')(environ, start_response)
+        environ['library.tenant'] = name
+        with storage.use_data_dir(data_dir):
+            return self.wsgi_app(environ, start_response)
+
+
+class PrefixSessionInterface(SecureCookieSessionInterface):
+    """Scope the session cookie to the library's path prefix, so being logged
+    in to one library does not clash with another on the same host"""
+
+    def get_cookie_path(self, app):
+        return request.script_root or super().get_cookie_path(app)
+
+
+def init_app(app):
+    """Install tenant routing if app.config['TENANT_MODE'] is set"""
+    registry = TenantRegistry(app.config['TENANTS_DIR'], app.config['TENANTS'])
+    app.extensions['tenants'] = registry
+    if app.config['TENANT_MODE']:
+        app.wsgi_app = TenantMiddleware(app.wsgi_app, registry, app.config['TENANT_MODE'], app.config['TENANT_DOMAIN'])
+    if app.config['TENANT_MODE'] == 'path':
+        app.session_interface = PrefixSessionInterface()
+    return registry
+
+
+def data_dirs(app):
+    """Every data directory this app serves"""
+    if app.config['TENANT_MODE']:
+        return app.extensions['tenants'].data_dirs()
+    return [storage.DATA_DIR]
@@ -0,0 +1,354 @@
+"""Write-ahead log persistence for the data store.
+
+Enabled with LIBRARY_STORAGE_MODE=wal. Instead of rewriting a whole JSON
+file on every save, storage.save() diffs the new data against what was last
+logged and appends only the changed records (one JSON line each) to
+data/wal-NNNNNN.log:
+
+    {"f": "books.json", "t": "list", "k": 7, "v": {...}}    upsert by id
+    {"f": "holds.json", "t": "dict", "k": "7", "d": 1}      delete a key
+    {"f": "stats.json", "v": {...}}                          replace all
+
+Saves that arrive within a short window share one fsync (group commit), so
+throughput scales with requests per fsync rather than with file size. A
+background checkpoint periodically writes the JSON files as snapshots and
+drops the log segments they cover; on startup the remaining segments are
+replayed over the snapshots.
+
+The in-memory documents are authoritative, so WAL mode must only be used
+with a single process (threads are fine). The store holds an exclusive lock
+on data/wal.lock while open, and a second process opening the same
+directory fails instead of replaying and deleting the live log.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process guard
+    fcntl = None
+
+COMMIT_WINDOW = float(os.environ.get('LIBRARY_WAL_WINDOW', 0.002))    # seconds
+CHECKPOINT_RECORDS = 1000
+CHECKPOINT_INTERVAL = 60    # seconds
+
+
+def fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:  # not supported on Windows
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def entries_kind(data):
+    if isinstance(data, dict):
+        return 'dict'
+    if isinstance(data, list) and all(isinstance(item, dict) and 'id' in item for item in data):
+        return 'list'
+    return 'whole'
+
+
+def entries(data):
+    """Split a document into (kind, {key: (serialized, value)}) for diffing"""
+    kind = entries_kind(data)
+    if kind == 'dict':
+        return kind, {key: (json.dumps(value, sort_keys=True), value) for key, value in data.items()}
+    if kind == 'list':
+        return kind, {item['id']: (json.dumps(item, sort_keys=True), item) for item in data}
+    return kind, {}
+
+
+class GroupCommitLog:
+    """Append-only log where concurrent writers share fsyncs.
+
+    Writers enqueue lines, then wait(). The first waiter becomes the leader:
+    it lingers for the commit window so others can join, then writes and
+    fsyncs everything pending at once and wakes all writers it covered.
+    """
+
+    def __init__(self, directory, window=COMMIT_WINDOW):
+        self.directory = directory
+        self.window = window
+        self.cond = threading.Condition(threading.Lock())
+        self.pending = []
+        self.next_batch = 1
+        self.flushed = 0
+        self.flushing = False
+        self.failed = None
+        self.segments = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.startswith('wal-') and name.endswith('.log')
+        )
+        self.file = None
+
+    def open_segment(self):
+        last = os.path.basename(self.segments[-1]) if self.segments else 'wal-000000.log'
+        path = os.path.join(self.directory, f'wal-{int(last[4:10]) + 1:06d}.log')
+        self.file = open(path, 'ab')
+        self.segments.append(path)
+        fsync_dir(self.directory)
+
+    def enqueue(self, lines):
+        """Queue lines for the next flush and return the batch to wait for"""
+        with self.cond:
+            if self.failed:
+                raise OSError('write-ahead log is unavailable after a failed write') from self.failed
+            self.pending.extend(lines)
+            return self.next_batch
+
+    def wait(self, batch):
+        """Block until `batch` is durable, leading the flush if nobody is"""
+        with self.cond:
+            while self.flushed < batch:
+                if self.failed:
+                    raise OSError('write-ahead log is unavailable after a failed write') from self.failed
+                if self.flushing:
+                    self.cond.wait()
+                    continue
+
+                self.flushing = True
+                if self.window:
+                    self.cond.wait(self.window)
+                lines, self.pending = self.pending, []
+                flushing_batch = self.next_batch
+                self.next_batch += 1
+                error = None
+                self.cond.release()
+                try:
+                    self.file.write(b''.join(lines))
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                except BaseException as exc:
+                    error = exc
+                finally:
+                    self.cond.acquire()
+                self.flushing = False
+                if error:
+                    self.failed = error
+                else:
+                    self.flushed = flushing_batch
+                self.cond.notify_all()
+
+    def rotate(self):
+        """Flush everything pending, start a new segment and return the old ones.
+        The caller must stop new enqueues while this runs."""
+        with self.cond:
+            batch = self.next_batch if self.pending else self.flushed
+        self.wait(batch)
+        with self.cond:
+            while self.flushing:
+                self.cond.wait()
+            old = list(self.segments)
+            self.file.close()
+            self.open_segment()
+            self.segments = self.segments[-1:]
+            return old
+
+
+class WALStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.pid = os.getpid()
+        self.lock = threading.RLock()
+        self.docs = {}
+        self.shadows = {}
+        self.versions = {}
+        self.records_since_checkpoint = 0
+        os.makedirs(directory, exist_ok=True)
+        self.lock_file = self.acquire_directory(directory)
+        self.log = GroupCommitLog(directory)
+        had_log = bool(self.log.segments)
+        self.recover()
+        self.log.open_segment()
+        if had_log:
+            self.checkpoint()
+        self.wakeup = threading.Event()
+        threading.Thread(target=self.run_checkpoints, name='library-wal-checkpoint', daemon=True).start()
+
+    @staticmethod
+    def acquire_directory(directory):
+        """Lock the directory for this process, or raise if another has it"""
+        lock_file = open(os.path.join(directory, 'wal.lock'), 'a')
+        if fcntl is None:
+            return lock_file
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise RuntimeError(
+                f'{directory} is in use by another process in WAL mode; '
+                'run a single server process and let it run the background jobs'
+            ) from None
+        return lock_file
+
+    def load_snapshot(self, name):
+        path = os.path.join(self.directory, name)
+        data = None
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+        self.docs[name] = data
+        self.versions[name] = 0
+        self.reset_shadow(name)
+
+    def reset_shadow(self, name):
+        kind, items = entries(self.docs[name])
+        self.shadows[name] = (kind, {key: text for key, (text, _) in items.items()})
+
+    def recover(self):
+        """Replay every log segment over the snapshots; returns the record count"""
+        replayed = 0
+        for index, path in enumerate(self.log.segments):
+            with open(path, 'rb') as f:
+                lines = f.read().splitlines()
+            for line_no, line in enumerate(lines):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn write at the very end of the log is expected after a crash
+                    if index == len(self.log.segments) - 1 and line_no == len(lines) - 1:
+                        break
+                    raise
+                self.apply(record)
+                replayed += 1
+        for name in self.docs:
+            self.reset_shadow(name)
+        return replayed
+
+    def apply(self, record):
+        name = record['f']
+        if name not in self.docs:
+            self.load_snapshot(name)
+        if 'k' not in record:
+            self.docs[name] = record['v']
+            return
+
+        doc = self.docs[name]
+        if doc is None:
+            doc = self.docs[name] = {} if record['t'] == 'dict' else []
+        key = record['k']
+        if record['t'] == 'dict':
+            if record.get('d'):
+                doc.pop(key, None)
+            else:
+                doc[key] = record['v']
+        else:
+            position = next((i for i, item in enumerate(doc) if item['id'] == key), None)
+            if record.get('d'):
+                if position is not None:
+                    del doc[position]
+            elif position is None:
+                doc.append(record['v'])
+            else:
+                doc[position] = record['v']
+
+    def load(self, name, default=None):
+        return self.load_versioned(name, default)[1]
+
+    def load_versioned(self, name, default=None):
+        """(version, data) of a document, taken together"""
+        with self.lock:
+            if name not in self.docs:
+                self.load_snapshot(name)
+            data = self.docs[name]
+            version = self.versions[name]
+        if data is None:
+            return version, default() if default else None
+        return version, data
+
+    def save(self, name, data, changed=None):
+        batch = self.write(name, data, changed)
+        if batch is not None:
+            self.sync(batch)
+
+    def write(self, name, data, changed=None):
+        """Apply a save in memory and queue its records; returns the batch to
+        sync() on before the save is durable, or None if nothing changed"""
+        with self.lock:
+            if name not in self.docs:
+                self.load_snapshot(name)
+            old_kind, old_items = self.shadows[name]
+            if changed is not None and old_kind == entries_kind(data):
+                records = self.diff_hinted(name, data, changed)
+            else:
+                kind, items = entries(data)
+                records = []
+                if kind == 'whole' or kind != old_kind:
+                    records.append({'f': name, 'v': data})
+                else:
+                    for key, (text, value) in items.items():
+                        if old_items.get(key) != text:
+                            records.append({'f': name, 't': kind, 'k': key, 'v': value})
+                    for key in old_items.keys() - items.keys():
+                        records.append({'f': name, 't': kind, 'k': key, 'd': 1})
+                self.shadows[name] = (kind, {key: text for key, (text, _) in items.items()})
+            self.docs[name] = data
+            self.versions[name] += 1
+            if not records:
+                return None
+            batch = self.log.enqueue([json.dumps(r).encode() + b'\n' for r in records])
+            self.records_since_checkpoint += len(records)
+        return batch
+
+    def sync(self, batch):
+        """Block until `batch` is fsynced"""
+        self.log.wait(batch)
+        if self.records_since_checkpoint >= CHECKPOINT_RECORDS:
+            self.wakeup.set()
+
+    def diff_hinted(self, name, data, changed):
+        """Records for a list of records or a dict where only the `changed`
+        ids or keys (and any added or removed ones) need to be serialized"""
+        kind, shadow = self.shadows[name]
+        by_key = data if kind == 'dict' else {item['id']: item for item in data}
+        records = []
+        for key in set(changed) | (by_key.keys() - shadow.keys()):
+            if key in by_key:
+                text = json.dumps(by_key[key], sort_keys=True)
+                if shadow.get(key) != text:
+                    shadow[key] = text
+                    records.append({'f': name, 't': kind, 'k': key, 'v': by_key[key]})
+        for key in shadow.keys() - by_key.keys():
+            del shadow[key]
+            records.append({'f': name, 't': kind, 'k': key, 'd': 1})
+        return records
+
+    def checkpoint(self):
+        """Write every document as a snapshot and drop the log it covers"""
+        with self.lock:
+            old_segments = self.log.rotate()
+            snapshot = {name: json.dumps(doc, indent=2) for name, doc in self.docs.items() if doc is not None}
+            self.records_since_checkpoint = 0
+        for name, text in snapshot.items():
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=f'.{name}.', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, os.path.join(self.directory, name))
+        fsync_dir(self.directory)
+        for path in old_segments:
+            os.remove(path)
+
+    def run_checkpoints(self):
+        last = time.monotonic()
+        while True:
+            self.wakeup.wait(CHECKPOINT_INTERVAL)
+            self.wakeup.clear()
+            due = time.monotonic() - last >= CHECKPOINT_INTERVAL
+            if self.records_since_checkpoint >= CHECKPOINT_RECORDS or (due and self.records_since_checkpoint):
+                try:
+                    self.checkpoint()
+                except Exception:
+                    traceback.print_exc()
+                last = time.monotonic()
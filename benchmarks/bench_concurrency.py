@@ -0,0 +1,140 @@
+"""Compare how the threaded WSGI server and the ASGI mode cope with many
+idle/slow connections.
+
+For each level, N sockets are opened that send a partial request and then
+stall (a slow client). While they are held open, a burst of normal requests
+is fired and their latency measured, along with the server's thread count
+and memory.
+
+    python benchmarks/bench_concurrency.py [--levels 10,100,500,1000]
+"""
+import argparse
+import os
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SERVERS = {
+    'wsgi': [sys.executable, '-c',
+             'import sys; from werkzeug.serving import run_simple; from app import create_app; '
+             'run_simple("127.0.0.1", int(sys.argv[1]), create_app(), threaded=True)'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'run_asgi:app', '--host', '127.0.0.1',
+             '--log-level', 'warning', '--port'],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server at {url} did not start')
+
+
+def process_info(pid):
+    info = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            info[key] = value.strip()
+    return int(info['Threads']), int(info['VmRSS'].split()[0]) / 1024
+
+
+def open_slow_clients(port, count):
+    sockets = []
+    for _ in range(count):
+        try:
+            s = socket.create_connection(('127.0.0.1', port), timeout=2)
+            s.sendall(b'GET /login HTTP/1.1\r\nHost: localhost\r\n')
+            sockets.append(s)
+        except OSError:
+            break
+    return sockets
+
+
+def probe(url, requests, concurrency):
+    def one(_):
+        start = time.perf_counter()
+        try:
+            urllib.request.urlopen(url, timeout=10).read()
+            return time.perf_counter() - start
+        except OSError:
+            return None
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    ok = [r for r in results if r is not None]
+    return len(ok), statistics.median(ok) * 1000 if ok else float('nan')
+
+
+def run_mode(mode, levels, requests, concurrency, data_dir):
+    port = free_port()
+    env = dict(os.environ, LIBRARY_DATA_DIR=data_dir)
+    server = subprocess.Popen(SERVERS[mode] + [str(port)], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}/login'
+    rows = []
+    try:
+        wait_ready(url)
+        for level in levels:
+            sockets = open_slow_clients(port, level)
+            time.sleep(0.5)
+            ok, p50 = probe(url, requests, concurrency)
+            threads, rss = process_info(server.pid)
+            rows.append((mode, len(sockets), f'{ok}/{requests}', f'{p50:.1f}', threads, f'{rss:.1f}'))
+            for s in sockets:
+                s.close()
+            time.sleep(0.5)
+    finally:
+        server.terminate()
+        server.wait()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--levels', default='10,100,500,1000')
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--modes', default='wsgi,asgi')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    data_dir = tempfile.mkdtemp(prefix='library-bench-')
+    shutil.copytree(os.path.join(ROOT, 'data'), data_dir, dirs_exist_ok=True)
+    try:
+        levels = [int(n) for n in args.levels.split(',')]
+        rows = []
+        for mode in args.modes.split(','):
+            rows.extend(run_mode(mode, levels, args.requests, args.concurrency, data_dir))
+    finally:
+        shutil.rmtree(data_dir)
+
+    header = ('mode', 'idle conns', 'ok', 'p50 ms', 'threads', 'rss MB')
+    print(' | '.join(f'{h:>10}' for h in header))
+    for row in rows:
+        print(' | '.join(f'{str(c):>10}' for c in row))
+
+
+if __name__ == '__main__':
+    main()
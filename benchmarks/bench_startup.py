@@ -0,0 +1,87 @@
+"""Track cold-start cost: module import time and time to first response.
+
+Runs each measurement in a fresh interpreter, the way a new worker starts.
+Time to first response is measured with an empty template bytecode cache
+(cold) and again with the cache filled by the previous run (warm).
+
+    python benchmarks/bench_startup.py [--top 15] [--runs 5]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+FIRST_RESPONSE = '''
+import sys
+from app import create_app
+app = create_app()
+app.config['JOBS_ENABLED'] = False
+client = app.test_client()
+assert client.get('/login').status_code == 200
+print('qrcode loaded' if 'qrcode' in sys.modules else 'qrcode not loaded')
+'''
+
+
+def import_times(env, top):
+    """Parse `python -X importtime` output into (cumulative_us, module) rows"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'from app import create_app; create_app()'],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), module.rstrip()[1:]))
+    total = sum(us for us, module in rows if not module.startswith(' '))
+    return total, sorted(rows, reverse=True)[:top]
+
+
+def first_response(env):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', FIRST_RESPONSE], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    return (time.perf_counter() - start) * 1000, result.stdout.strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='library-bench-')
+    data_dir = os.path.join(work_dir, 'data')
+    template_cache = os.path.join(work_dir, 'jinja_cache')
+    shutil.copytree(os.path.join(ROOT, 'data'), data_dir)
+    env = dict(os.environ, LIBRARY_DATA_DIR=data_dir, LIBRARY_TEMPLATE_CACHE=template_cache)
+
+    try:
+        total, rows = import_times(env, args.top)
+        print(f'Import time for create_app(): {total / 1000:.1f} ms (top-level imports)')
+        print(f'{"cumulative ms":>14}  module')
+        for us, module in rows:
+            print(f'{us / 1000:>14.1f}  {module}')
+
+        cold, warm = [], []
+        for _ in range(args.runs):
+            shutil.rmtree(template_cache, ignore_errors=True)
+            ms, note = first_response(env)
+            cold.append(ms)
+            ms, note = first_response(env)
+            warm.append(ms)
+        print()
+        print(f'Time to first response, cold template cache: {statistics.median(cold):.1f} ms')
+        print(f'Time to first response, warm template cache: {statistics.median(warm):.1f} ms')
+        print(f'After first response: {note}')
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
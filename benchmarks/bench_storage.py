@@ -0,0 +1,83 @@
+"""Compare write throughput of the default file-rewrite storage and WAL mode.
+
+Each mode runs in a fresh interpreter against a copy of the data, padded to
+--books books, with --threads threads each doing --writes Book.update calls.
+File mode rewrites books.json on every write (without fsync); WAL mode
+appends one record per write and shares fsyncs between concurrent writers.
+With more than one thread, WAL mode must need fewer fsyncs than writes, or
+the script exits with an error.
+
+    python benchmarks/bench_storage.py [--books 5000] [--threads 16] [--writes 50]
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+WORKLOAD = '''
+import sys, threading, time
+from app import storage
+from app.models import Book
+threads, writes = int(sys.argv[1]), int(sys.argv[2])
+book_ids = [b['id'] for b in Book.load_all()]
+
+def worker(n):
+    for i in range(writes):
+        book_id = book_ids[(n * writes + i) % len(book_ids)]
+        Book.update(book_id, borrowed_date=f'{n}-{i}')
+
+start = time.perf_counter()
+workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+for w in workers:
+    w.start()
+for w in workers:
+    w.join()
+elapsed = time.perf_counter() - start
+fsyncs = storage.get_wal_store().log.flushed if storage.STORAGE_MODE == 'wal' else 0
+print(f'{threads * writes / elapsed:.0f} {fsyncs}')
+'''
+
+
+def make_data(path, books):
+    shutil.copytree(os.path.join(ROOT, 'data'), path)
+    with open(os.path.join(path, 'books.json')) as f:
+        catalog = json.load(f)
+    template = catalog[0]
+    for book_id in range(len(catalog) + 1, books + 1):
+        catalog.append(dict(template, id=book_id, title=f'Book {book_id}'))
+    with open(os.path.join(path, 'books.json'), 'w') as f:
+        json.dump(catalog, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--writes', type=int, default=50)
+    args = parser.parse_args()
+
+    print(f'{"mode":>6} | {"writes/s":>9} | {"fsyncs":>7}')
+    for mode in ('files', 'wal'):
+        work_dir = tempfile.mkdtemp(prefix='library-bench-')
+        try:
+            data_dir = os.path.join(work_dir, 'data')
+            make_data(data_dir, args.books)
+            env = dict(os.environ, LIBRARY_DATA_DIR=data_dir, LIBRARY_STORAGE_MODE=mode)
+            result = subprocess.run([sys.executable, '-c', WORKLOAD, str(args.threads), str(args.writes)],
+                                    cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+            rate, fsyncs = result.stdout.split()
+            print(f'{mode:>6} | {rate:>9} | {fsyncs:>7}')
+        finally:
+            shutil.rmtree(work_dir)
+    writes = args.threads * args.writes
+    if args.threads > 1 and int(fsyncs) >= writes:
+        sys.exit(f'WAL mode did not share fsyncs: {fsyncs} fsyncs for {writes} writes')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,27 @@
 import os
+import sys
 import json
+from app import storage, tenants
 from app.models import User, Book
 
+# `python init_db.py NAME` sets up one library of a multi-library deployment
+if len(sys.argv) > 1:
+    if not tenants.TENANT_NAME.match(sys.argv[1]):
+        sys.exit(f"Invalid library name: {sys.argv[1]!r} (use lowercase letters, digits and dashes)")
+    storage.DATA_DIR = os.path.join(tenants.default_root(), sys.argv[1])
+    print(f"Initializing library '{sys.argv[1]}' in {storage.DATA_DIR}")
+
 # Clear existing data
-data_dir = os.path.join(os.path.dirname(__file__), 'data')
+data_dir = storage.DATA_DIR
 os.makedirs(data_dir, exist_ok=True)
 
-# Clear old data files
-for file in ['users.json', 'books.json', 'book_requests.json']:
+# Clear old data files. Hold queues, recommendations and analytics refer to
+# book ids and usernames that the new data reuses, and a leftover write-ahead
+# log would be replayed over the new files
+data_files = ['users.json', 'books.json', 'book_requests.json', 'holds.json',
+              'recommendations.json', 'analytics.json', 'jobs.json']
+data_files += sorted(f for f in os.listdir(data_dir) if f.startswith('wal-') and f.endswith('.log'))
+for file in data_files:
     file_path = os.path.join(data_dir, file)
     if os.path.exists(file_path):
         os.remove(file_path)
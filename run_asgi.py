@@ -0,0 +1,24 @@
+import os
+
+from app import create_app, storage, tenants
+from app.asgi import WSGIToASGI
+
+flask_app = create_app()
+if storage.STORAGE_MODE == 'wal':
+    # Open the WAL stores now, so a second worker process fails at startup
+    # on the directory lock rather than on its first request
+    for data_dir in tenants.data_dirs(flask_app):
+        with storage.use_data_dir(data_dir):
+            storage.get_wal_store()
+app = WSGIToASGI(flask_app)
+
+if __name__ == '__main__':
+    import uvicorn
+    workers = int(os.environ.get('LIBRARY_WORKERS', 1))
+    if storage.STORAGE_MODE == 'wal' and workers > 1:
+        raise SystemExit('LIBRARY_STORAGE_MODE=wal keeps data in one process; set LIBRARY_WORKERS=1')
+    if workers > 1:
+        # Live events are broadcast within one process, so pages served by
+        # different workers would miss each other's changes
+        os.environ['LIBRARY_LIVE_UPDATES'] = '0'
+    uvicorn.run('run_asgi:app', host='localhost', port=8000, workers=workers)
@@ -0,0 +1,83 @@
+"""Production launcher: runs the app under gunicorn's pre-forking server.
+
+    python serve.py --workers 4 --threads 8 --bind 0.0.0.0:8000
+
+Options default to the LIBRARY_WORKERS, LIBRARY_THREADS and LIBRARY_BIND
+environment variables. The app is created and its data caches warmed in the
+master before forking, so workers share those pages copy-on-write instead
+of each parsing the JSON files on their first request. Workers revalidate
+cached files against their mtime, so a write in one worker is picked up by
+the others on their next access. Templates are compiled in the master too,
+and written to the on-disk bytecode cache for workers started later.
+
+Live catalog updates are turned off here: use run_asgi.py for them.
+"""
+import argparse
+import gc
+import os
+
+from gunicorn.app.base import BaseApplication
+
+from app import create_app, precompile_templates, storage, tenants
+from app.models import User, Book, BookRequest, Hold, Stats
+
+
+def warm_caches():
+    """Load the data files and build the lookup indexes used on every request"""
+    Book.load_index()
+    User.load_index()
+    BookRequest.load_index()
+    Hold.load_all()
+    Stats.load_stats()
+
+
+class LibraryServer(BaseApplication):
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the library app with gunicorn')
+    parser.add_argument('--bind', default=os.environ.get('LIBRARY_BIND', '0.0.0.0:8000'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('LIBRARY_WORKERS', (os.cpu_count() or 1) * 2 + 1)))
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('LIBRARY_THREADS', 4)))
+    parser.add_argument('--timeout', type=int, default=30)
+    args = parser.parse_args()
+    if storage.STORAGE_MODE == 'wal' and args.workers > 1:
+        parser.error('LIBRARY_STORAGE_MODE=wal keeps data in one process; use --workers 1 and raise --threads')
+
+    # An endless event stream would pin one of the worker's threads per open
+    # catalog page, so the live feed is only offered under ASGI
+    app = create_app({'LIVE_UPDATES': False})
+    # A WAL store owns a log file and a checkpoint thread, so it must be
+    # opened in the worker rather than inherited across the fork
+    if storage.STORAGE_MODE != 'wal':
+        for data_dir in tenants.data_dirs(app):
+            with storage.use_data_dir(data_dir):
+                warm_caches()
+    precompile_templates(app)
+    # Keep the warmed objects out of the collector so forked workers do not
+    # touch (and copy) their pages on every collection
+    gc.freeze()
+
+    LibraryServer(app, {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread' if args.threads > 1 else 'sync',
+        'timeout': args.timeout,
+        'preload_app': True,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()